@@ -1,14 +1,32 @@
+import ast
+import collections
+import hashlib
+import importlib.util
 import inspect
 import json
+import marshal
 import math
+import multiprocessing
 import numpy
 import os
 import subprocess
+import time
 
 import traceback
 
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None # the persistent cache of flattened components is disabled without it
+
 circle_step = 5
 
+# Curves are tessellated such that the chord error stays below a tolerance (in mm). Exports use a fixed tolerance,
+# the editor derives one from the zoom level. Without a tolerance, the fixed 'circle_step' (in degrees) is used.
+export_tolerance = 0.001
+min_circle_steps = 8
+max_circle_steps = 1024
+
 primitives = {"circle", "rectangle", "polygon"}
 params_circle = [
 	("layer"  , "copper1-top"),
@@ -58,6 +76,164 @@ def equalize_arrays(*arrays):
 	n = min(len(x) for x in arrays)
 	return tuple(numpy.array(x)[:n] for x in arrays)
 
+def make_hashable(value):
+	if isinstance(value, dict):
+		return ("dict",) + tuple(sorted((k, make_hashable(v)) for (k, v) in value.items()))
+	if isinstance(value, (list, tuple)):
+		return (type(value).__name__,) + tuple(make_hashable(v) for v in value)
+	if isinstance(value, numpy.ndarray):
+		return ("ndarray",) + tuple(make_hashable(v) for v in value.tolist())
+	return (type(value).__name__, value) # the type is included because 1 == 1.0 == True
+
+class LruCache:
+	
+	def __init__(self, size):
+		self.size = size
+		self.data = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+	
+	def get(self, key):
+		value = self.data.get(key)
+		if value is None:
+			self.misses += 1
+		else:
+			self.data.move_to_end(key)
+			self.hits += 1
+		return value
+	
+	def put(self, key, value):
+		self.data[key] = value
+		self.data.move_to_end(key)
+		if len(self.data) > self.size:
+			self.data.popitem(last=False)
+	
+	def clear(self):
+		self.data.clear()
+	
+	def discard(self, predicate):
+		for key in [key for key in self.data if predicate(key)]:
+			del self.data[key]
+	
+	def stats(self):
+		return (self.hits, self.misses, len(self.data))
+
+def file_stamp(filename):
+	st = os.stat(filename)
+	return (st.st_mtime, st.st_size)
+
+def cache_directory():
+	path = os.environ.get("XDG_CACHE_HOME")
+	if not path:
+		path = os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(path, "alterpcb-python")
+
+def compiled_cache_file(filename):
+	key = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+	return os.path.join(cache_directory(), "compiled", key + ".bin")
+
+def load_compiled(filename, build):
+	# Returns build(source) for the contents of a file, using a marshalled copy from the cache directory if the file
+	# didn't change. The cache is used directly if the mtime and size still match, otherwise the content hash is checked.
+	cache_file = compiled_cache_file(filename)
+	path = filename # code objects store the file name as it was given
+	stamp = file_stamp(filename)
+	header = None
+	if os.path.exists(cache_file):
+		try:
+			with open(cache_file, "rb") as f:
+				header = marshal.load(f)
+				if header[:4] == (importlib.util.MAGIC_NUMBER, path, stamp[0], stamp[1]):
+					return marshal.load(f)
+		except (EOFError, ValueError, TypeError, IndexError):
+			header = None
+	with open(filename, "rb") as f:
+		source = f.read()
+	digest = hashlib.sha1(source).hexdigest()
+	if header is not None and header[0] == importlib.util.MAGIC_NUMBER and header[1] == path and header[4] == digest:
+		try:
+			with open(cache_file, "rb") as f:
+				marshal.load(f)
+				result = marshal.load(f)
+		except (EOFError, ValueError, TypeError, IndexError, IOError, OSError):
+			result = build(source)
+	else:
+		result = build(source)
+	try:
+		if not os.path.exists(os.path.dirname(cache_file)):
+			os.makedirs(os.path.dirname(cache_file))
+		with open(cache_file + ".tmp", "wb") as f:
+			marshal.dump((importlib.util.MAGIC_NUMBER, path, stamp[0], stamp[1], digest), f)
+			marshal.dump(result, f)
+		os.replace(cache_file + ".tmp", cache_file)
+	except (IOError, OSError, ValueError):
+		print("Could not write compiled cache for '%s'!" % (filename))
+	return result
+
+def read_json(filename):
+	return load_compiled(filename, lambda source: json.loads(source.decode("utf-8")))
+
+def compile_python(filename):
+	return load_compiled(filename, lambda source: compile(source, filename, "exec"))
+
+def source_hash(data):
+	return hashlib.sha1(data).hexdigest()
+
+def scan_components(filename):
+	# Returns the index entry for a library file: the names of the components it defines, a hash of the file, and for
+	# JSON files a separate hash for each component so changes to one component don't affect the others.
+	with open(filename, "rb") as f:
+		entry = {"hash": source_hash(f.read())}
+	if filename.endswith(".json"):
+		data = read_json(filename)
+		entry["names"] = [component["name"] for component in data]
+		entry["hashes"] = dict((component["name"], source_hash(json.dumps(component, sort_keys=True).encode("utf-8"))) for component in data)
+	else:
+		entry["names"] = scan_python_components(filename)
+		entry["hashes"] = None
+	return entry
+
+def make_plain(value):
+	# converts numpy values to plain Python values so they can be marshalled
+	if isinstance(value, dict):
+		return dict((k, make_plain(v)) for (k, v) in value.items())
+	if isinstance(value, list):
+		return [make_plain(v) for v in value]
+	if isinstance(value, tuple):
+		return tuple(make_plain(v) for v in value)
+	if isinstance(value, (numpy.ndarray, numpy.generic)):
+		return value.tolist()
+	return value
+
+def scan_python_components(filename):
+	# Finds the names of all components defined with the '@component' decorator at the top level of the file. If
+	# 'component' is used in any other way, the names can't be known without running the code, so None is returned.
+	with open(filename, "r") as f:
+		try:
+			tree = ast.parse(f.read(), filename)
+		except SyntaxError:
+			return None
+	references = sum(1 for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id == "component")
+	names = []
+	for node in tree.body:
+		if not isinstance(node, ast.FunctionDef):
+			continue
+		for decorator in node.decorator_list:
+			if isinstance(decorator, ast.Name) and decorator.id == "component":
+				names.append(node.name)
+			elif isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Name) and decorator.func.id == "component":
+				name = node.name
+				for keyword in decorator.keywords:
+					if keyword.arg == "name":
+						try:
+							name = ast.literal_eval(keyword.value)
+						except ValueError:
+							return None
+				names.append(name)
+	if len(names) != references:
+		return None
+	return names
+
 def flip_layer(layer):
 	if layer.endswith("-top"):
 		return layer[:-4] + "-bot"
@@ -122,6 +298,86 @@ def transform_component(shape, xfrom, yfrom, xto, yto, angle, flip, mirror):
 		shape["mirror"] = not shape["mirror"]
 	return shape
 
+# Batched versions of the transform functions: these take a list of shapes and transform all coordinates with a
+# single numpy operation.
+
+def shape_column(shapes, name):
+	return numpy.array([shape[name] for shape in shapes], dtype=numpy.float64)
+
+def transform_many_points(shapes, xname, yname, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	(px, py) = transform_point(shape_column(shapes, xname), shape_column(shapes, yname), xfrom, yfrom, xto, yto, angle, flip, mirror)
+	return (px.tolist(), py.tolist())
+
+def transform_many_angles(shapes, name, angle, flip, mirror):
+	if flip != mirror:
+		return ((angle - shape_column(shapes, name)) % 360.0).tolist()
+	else:
+		return ((angle + shape_column(shapes, name)) % 360.0).tolist()
+
+def transform_many_vertices(shapes, xname, yname, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	vertices = [equalize_arrays(shape[xname], shape[yname]) for shape in shapes]
+	split = numpy.cumsum([len(px) for (px, py) in vertices])[:-1]
+	px = numpy.concatenate([numpy.zeros(0)] + [px for (px, py) in vertices])
+	py = numpy.concatenate([numpy.zeros(0)] + [py for (px, py) in vertices])
+	(px, py) = transform_point(px, py, xfrom, yfrom, xto, yto, angle, flip, mirror)
+	return [(qx.tolist(), qy.tolist()) for (qx, qy) in zip(numpy.split(px, split), numpy.split(py, split))]
+
+def transform_many_circle(shapes, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	(px, py) = transform_many_points(shapes, "x", "y", xfrom, yfrom, xto, yto, angle, flip, mirror)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"]) = (px[i], py[i])
+		if flip:
+			shape["layer"] = flip_layer(shape["layer"])
+		result.append(shape)
+	return result
+
+def transform_many_rectangle(shapes, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	(px, py) = transform_many_points(shapes, "x", "y", xfrom, yfrom, xto, yto, angle, flip, mirror)
+	pa = transform_many_angles(shapes, "angle", angle, flip, mirror)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"], shape["angle"]) = (px[i], py[i], pa[i])
+		if flip:
+			shape["layer"] = flip_layer(shape["layer"])
+		result.append(shape)
+	return result
+
+def transform_many_polygon(shapes, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	vertices = transform_many_vertices(shapes, "x", "y", xfrom, yfrom, xto, yto, angle, flip, mirror)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"]) = vertices[i]
+		if flip:
+			shape["layer"] = flip_layer(shape["layer"])
+		result.append(shape)
+	return result
+
+def transform_many_component(shapes, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	(px, py) = transform_many_points(shapes, "x", "y", xfrom, yfrom, xto, yto, angle, flip, mirror)
+	pa = transform_many_angles(shapes, "angle", angle, flip, mirror)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"], shape["angle"]) = (px[i], py[i], pa[i])
+		if flip:
+			shape["flip"] = not shape["flip"]
+		if mirror:
+			shape["mirror"] = not shape["mirror"]
+		result.append(shape)
+	return result
+
+# batched versions of the standard transform functions, used when a component doesn't provide its own
+transform_many_defaults = {
+	transform_circle   : transform_many_circle   ,
+	transform_rectangle: transform_many_rectangle,
+	transform_polygon  : transform_many_polygon  ,
+	transform_component: transform_many_component,
+}
+
 def transform_coordinate(x, y, origin_x, origin_y, angle):
 	angle_sin = math.sin(math.radians(angle))
 	angle_cos = math.cos(math.radians(angle))
@@ -181,6 +437,80 @@ def snap_component(shape, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y
 	(shape["x"], shape["y"]) = snap_point(shape["x"], shape["y"], grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
 	return shape
 
+# Batched versions of the snap functions, analogous to the batched transform functions.
+
+def snap_many_points(shapes, xname, yname, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+	(px, py) = snap_point(shape_column(shapes, xname), shape_column(shapes, yname), grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	return (px.tolist(), py.tolist())
+
+def snap_many_values(shapes, name, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+	return snap_value(shape_column(shapes, name), grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle).tolist()
+
+def snap_many_vertices(shapes, xname, yname, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+	vertices = [equalize_arrays(shape[xname], shape[yname]) for shape in shapes]
+	split = numpy.cumsum([len(px) for (px, py) in vertices])[:-1]
+	px = numpy.concatenate([numpy.zeros(0)] + [px for (px, py) in vertices])
+	py = numpy.concatenate([numpy.zeros(0)] + [py for (px, py) in vertices])
+	(px, py) = snap_point(px, py, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	return [(qx.tolist(), qy.tolist()) for (qx, qy) in zip(numpy.split(px, split), numpy.split(py, split))]
+
+def snap_many_circle(shapes, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+	(px, py) = snap_many_points(shapes, "x", "y", grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	pr = snap_many_values(shapes, "radius", grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"]) = (px[i], py[i])
+		if not shape["pad"]:
+			shape["radius"] = pr[i]
+		result.append(shape)
+	return result
+
+def snap_many_rectangle(shapes, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+	(x, y) = (shape_column(shapes, "x"), shape_column(shapes, "y"))
+	(w, h) = (shape_column(shapes, "width") / 2, shape_column(shapes, "height") / 2)
+	(px, py) = snap_point(x, y, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	(x1, y1) = snap_point(x - w, y - h, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	(x2, y2) = snap_point(x + w, y + h, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	(cx, cy, cw, ch) = (((x1 + x2) / 2).tolist(), ((y1 + y2) / 2).tolist(), (x2 - x1).tolist(), (y2 - y1).tolist())
+	(px, py) = (px.tolist(), py.tolist())
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		if shape["pad"]:
+			(shape["x"], shape["y"]) = (px[i], py[i])
+		else:
+			(shape["x"], shape["y"]) = (cx[i], cy[i])
+			(shape["width"], shape["height"]) = (cw[i], ch[i])
+		result.append(shape)
+	return result
+
+def snap_many_polygon(shapes, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+	vertices = snap_many_vertices(shapes, "x", "y", grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"]) = vertices[i]
+		result.append(shape)
+	return result
+
+def snap_many_component(shapes, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+	(px, py) = snap_many_points(shapes, "x", "y", grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"]) = (px[i], py[i])
+		result.append(shape)
+	return result
+
+# batched versions of the standard snap functions, used when a component doesn't provide its own
+snap_many_defaults = {
+	snap_circle   : snap_many_circle   ,
+	snap_rectangle: snap_many_rectangle,
+	snap_polygon  : snap_many_polygon  ,
+	snap_component: snap_many_component,
+}
+
 def handles_circle(shape):
 	(x, y, r) = (shape["x"], shape["y"], shape["radius"])
 	return [
@@ -307,24 +637,72 @@ def handlemove_component(shape, index, x, y):
 
 class Library:
 	
+	shapes_cache_size = 4096
+	flat_cache_size = 1024
+	disk_cache_size = 256 * 1024 * 1024
+	
 	def __init__(self):
 		self.components = {}
-		self.global_list = []
+		self.lazy_components = {}
+		self.global_vars = {}
+		self.shapes_cache = LruCache(self.shapes_cache_size)
+		self.flat_cache = LruCache(self.flat_cache_size)
+		
+		# file that defined each component, and the components defined by each file
+		self.loading_file = None
+		self.component_files = {}
+		self.file_components = collections.OrderedDict()
+		self.file_stamps = {}
+		
+		# position of each file in the load order, later files override components defined by earlier files
+		self.file_order = {}
+		
+		# on-disk index of the components defined by each file, loaded when needed
+		self.index_cache_file = os.path.join(cache_directory(), "library_index.json")
+		self.index_cache = None
+		self.index_modified = False
+		
+		# persistent cache of flattened components, opened when needed
+		self.disk_cache_file = os.path.join(cache_directory(), "flat_cache.sqlite")
+		self.disk_cache = None
+		self.disk_cache_bytes = 0
+		self.core_hash = None
+		self.source_hashes = {}
+		
+		# components referenced by each component (discovered while flattening), this can contain cycles
+		self.dependencies = {}
+		self.self_references = 0
+		
 		self.register_primitive("circle"   , params_circle   , transform_circle   , snap_circle   , handles_circle   , handlemove_circle   )
 		self.register_primitive("rectangle", params_rectangle, transform_rectangle, snap_rectangle, handles_rectangle, handlemove_rectangle)
 		self.register_primitive("polygon"  , params_polygon  , transform_polygon  , snap_polygon  , handles_polygon  , handlemove_polygon  )
 	
+	def register_file_component(self, name):
+		# returns False if the component is already defined by a file that comes later in the load order
+		if self.loading_file is not None:
+			self.file_components[self.loading_file].append(name)
+			owner = self.component_files.get(name)
+			if owner is not None and self.file_order[owner] > self.file_order[self.loading_file]:
+				return False
+		else:
+			self.lazy_components.pop(name, None)
+		self.component_files[name] = self.loading_file
+		return True
+	
 	def register_primitive(self, name, base_params, transform, snap, handles, handlemove):
 		self.components[name] = {
 			"type": "primitive",
 			"base_params": base_params,
 			"transform": transform,
+			"transform_many": transform_many_defaults.get(transform),
 			"snap": snap,
+			"snap_many": snap_many_defaults.get(snap),
 			"handles": handles,
 			"handlemove": handlemove,
+			"lod_box": False,
 		}
 	
-	def register_component_func(self, name, func, params=None, transform=None, snap=None, handles=None, handlemove=None):
+	def register_component_func(self, name, func, params=None, transform=None, snap=None, handles=None, handlemove=None, transform_many=None, snap_many=None, lod_box=False):
 		if params is None:
 			(args, _, _, defaults) = inspect.getargspec(func)
 			if len(args) != 0 and (defaults is None or len(args) != len(defaults)):
@@ -334,62 +712,254 @@ class Library:
 				params.append((args[i], defaults[i]))
 		if transform is None:
 			transform = transform_component
+		if transform_many is None:
+			transform_many = transform_many_defaults.get(transform)
 		if snap is None:
 			snap = snap_component
+		if snap_many is None:
+			snap_many = snap_many_defaults.get(snap)
 		if handles is None:
 			handles = handles_component
 		if handlemove is None:
 			handlemove = handlemove_component
+		if not self.register_file_component(name):
+			return
 		self.components[name] = {
 			"type": "func",
 			"func": func,
 			"params": params,
 			"base_params": params_component if transform is transform_component else [],
 			"transform": transform,
+			"transform_many": transform_many,
 			"snap": snap,
+			"snap_many": snap_many,
 			"handles": handles,
 			"handlemove": handlemove,
+			"lod_box": lod_box,
 		}
 	
 	def register_component_shapes(self, name, shapes):
+		if not self.register_file_component(name):
+			return
 		self.components[name] = {
 			"type": "shapes",
 			"shapes": shapes,
 			"base_params": params_component,
 			"transform": transform_component,
+			"transform_many": transform_many_component,
 			"snap": snap_component,
+			"snap_many": snap_many_component,
 			"handles": handles_component,
 			"handlemove": handlemove_component,
+			"lod_box": False,
 		}
 	
+	def load_file(self, filename):
+		if filename.endswith(".json"):
+			self.load_json(filename)
+		else:
+			self.load_python(filename)
+	
+	def begin_file(self, filename):
+		if filename not in self.file_order:
+			self.file_order[filename] = len(self.file_order)
+		for name in self.file_components.get(filename, []):
+			if self.lazy_components.get(name) == filename:
+				del self.lazy_components[name]
+		self.loading_file = filename
+		self.file_components[filename] = []
+		self.file_stamps[filename] = file_stamp(filename)
+	
 	def load_json(self, filename):
-		with open(filename, "r") as f:
-			data = json.load(f)
-		for component in data:
-			self.register_component_shapes(component["name"], component["shapes"])
+		data = read_json(filename)
+		self.begin_file(filename)
+		try:
+			for component in data:
+				self.register_component_shapes(component["name"], component["shapes"])
+		finally:
+			self.loading_file = None
 	
 	def load_python(self, filename):
-		def component(func=None, name=None, params=None, transform=None, snap=None, handles=None, handlemove=None):
+		def component(func=None, name=None, params=None, transform=None, snap=None, handles=None, handlemove=None, transform_many=None, snap_many=None, lod_box=False):
 			if func is None:
-				return (lambda func, name=name, params=params, transform=transform, snap=snap, handles=handles, handlemove=handlemove:
-						component(func, name, params, transform, snap, handles, handlemove))
+				return (lambda func, name=name, params=params, transform=transform, snap=snap, handles=handles, handlemove=handlemove, transform_many=transform_many, snap_many=snap_many, lod_box=lod_box:
+						component(func, name, params, transform, snap, handles, handlemove, transform_many, snap_many, lod_box))
 			if name is None:
 				name = func.__name__
-			self.register_component_func(name, func, params, transform, snap, handles, handlemove)
+			self.register_component_func(name, func, params, transform, snap, handles, handlemove, transform_many, snap_many, lod_box)
 			return func
 		global_vars = {
 			"component": component,
 		}
-		with open(filename, "r") as f:
-			code = compile(f.read(), filename, "exec")
-		exec(code, global_vars)
-		self.global_list.append(global_vars) # preserve environment so we can call the functions later
+		code = compile_python(filename)
+		self.begin_file(filename)
+		try:
+			exec(code, global_vars)
+		finally:
+			self.loading_file = None
+		self.global_vars[filename] = global_vars # preserve environment so we can call the functions later
+	
+	def load_index_cache(self):
+		if self.index_cache is None:
+			self.index_cache = {}
+			if os.path.exists(self.index_cache_file):
+				try:
+					with open(self.index_cache_file, "r") as f:
+						self.index_cache = json.load(f)
+				except (IOError, OSError, ValueError):
+					print("Could not read library index '%s'!" % (self.index_cache_file))
+	
+	def save_index_cache(self):
+		try:
+			if not os.path.exists(os.path.dirname(self.index_cache_file)):
+				os.makedirs(os.path.dirname(self.index_cache_file))
+			with open(self.index_cache_file + ".tmp", "w") as f:
+				json.dump(self.index_cache, f)
+			os.replace(self.index_cache_file + ".tmp", self.index_cache_file)
+			self.index_modified = False
+		except (IOError, OSError):
+			print("Could not write library index '%s'!" % (self.index_cache_file))
+	
+	def index_valid(self, filename):
+		entry = self.index_cache.get(os.path.abspath(filename))
+		return (entry is not None and "hash" in entry and entry["stamp"] == list(file_stamp(filename)))
+	
+	def index_store(self, filename, entry):
+		entry["stamp"] = list(file_stamp(filename))
+		self.index_cache[os.path.abspath(filename)] = entry
+		self.index_modified = True
+	
+	def scan_file(self, filename):
+		if not self.index_valid(filename):
+			self.index_store(filename, scan_components(filename))
+		return self.index_cache[os.path.abspath(filename)]
+	
+	def add_lazy_component(self, name, filename):
+		owner = self.lazy_components.get(name, self.component_files.get(name))
+		if owner is None or self.file_order[owner] <= self.file_order[filename]:
+			self.lazy_components[name] = filename
+	
+	def index_file(self, filename):
+		if filename not in self.file_order:
+			self.file_order[filename] = len(self.file_order)
+		names = self.scan_file(filename)["names"]
+		if names is None:
+			print("Loading '" + filename + "' ...")
+			self.load_file(filename)
+			return
+		self.file_components[filename] = list(names)
+		self.file_stamps[filename] = file_stamp(filename)
+		for name in names:
+			self.add_lazy_component(name, filename)
+	
+	def index_files(self, filenames, processes=0):
+		# files are only scanned for component names here, they are loaded when one of their components is used
+		self.load_index_cache()
+		if processes > 1:
+			# scan new and modified files in worker processes, the results are merged in the normal order below
+			todo = [filename for filename in filenames if not self.index_valid(filename)]
+			if len(todo) > 1:
+				pool = multiprocessing.Pool(processes)
+				try:
+					results = pool.map(scan_components, todo)
+				finally:
+					pool.close()
+					pool.join()
+				for (filename, entry) in zip(todo, results):
+					self.index_store(filename, entry)
+		for filename in filenames:
+			self.index_file(filename)
+		if self.index_modified:
+			self.save_index_cache()
+	
+	def unload_file(self, filename):
+		for name in self.file_components.pop(filename):
+			if self.component_files.get(name) == filename:
+				del self.components[name]
+				del self.component_files[name]
+			if self.lazy_components.get(name) == filename:
+				del self.lazy_components[name]
+		del self.file_stamps[filename]
+		self.global_vars.pop(filename, None)
+	
+	def reload(self, filenames, processes=0):
+		
+		# find files that were removed, modified or added
+		changed_files = []
+		for filename in list(self.file_components.keys()):
+			if filename not in filenames:
+				changed_files.append(filename)
+			elif not os.path.exists(filename) or file_stamp(filename) != self.file_stamps[filename]:
+				changed_files.append(filename)
+		
+		# unload the old components, then index the new ones
+		changed = set()
+		for filename in changed_files:
+			changed.update(self.file_components[filename])
+			self.unload_file(filename)
+		# components that are no longer defined by the changed files fall back to the next file that defines them
+		for name in changed:
+			if name not in self.component_files and name not in self.lazy_components:
+				for filename in self.file_components:
+					if name in self.file_components[filename]:
+						self.add_lazy_component(name, filename)
+		self.file_order = {}
+		for filename in filenames:
+			self.file_order[filename] = len(self.file_order)
+		new_files = [filename for filename in filenames if filename not in self.file_components]
+		self.index_files(new_files, processes)
+		for filename in new_files:
+			changed.update(self.file_components[filename])
+		
+		# everything that depends on a changed component has to be flattened again
+		invalidated = self.component_dependents(changed)
+		self.shapes_cache.discard(lambda key: key[0] in invalidated)
+		self.flat_cache.discard(lambda key: key[0] in invalidated)
+		for name in invalidated:
+			self.dependencies.pop(name, None)
+		self.source_hashes = {}
+		return invalidated
+	
+	def component_dependents(self, names):
+		reverse = {}
+		for (name, deps) in self.dependencies.items():
+			for dep in deps:
+				reverse.setdefault(dep, []).append(name)
+		result = set(names)
+		stack = list(names)
+		while len(stack) != 0:
+			for name in reverse.get(stack.pop(), []):
+				if name not in result:
+					result.add(name)
+					stack.append(name)
+		return result
+	
+	def component_closure(self, name):
+		result = set([name])
+		stack = [name]
+		while len(stack) != 0:
+			for dep in self.dependencies.get(stack.pop(), ()):
+				if dep not in result:
+					result.add(dep)
+					stack.append(dep)
+		return result
+	
+	def add_dependency(self, name, dep):
+		if dep not in primitives:
+			self.dependencies.setdefault(name, set()).add(dep)
+	
+	def get_component(self, name):
+		filename = self.lazy_components.get(name)
+		if filename is not None:
+			print("Loading '" + filename + "' ...")
+			self.load_file(filename)
+		return self.components.get(name)
 	
 	def component_exists(self, name):
-		return (name in self.components)
+		return (self.get_component(name) is not None)
 	
 	def component_params(self, shape):
-		comp = self.components.get(shape["type"])
+		comp = self.get_component(shape["type"])
 		if comp is None:
 			raise Exception("Component '%s' does not exist!" % (shape["type"]))
 		params = [("type", shape["type"])]
@@ -401,7 +971,7 @@ class Library:
 		return params
 	
 	def component_defaults(self, shape):
-		comp = self.components.get(shape["type"])
+		comp = self.get_component(shape["type"])
 		if comp is None:
 			raise Exception("Component '%s' does not exist!" % (shape["type"]))
 		shape2 = {"type": shape["type"]}
@@ -413,67 +983,261 @@ class Library:
 		return shape2
 	
 	def component_transform(self, shape, xfrom=0.0, yfrom=0.0, xto=0.0, yto=0.0, angle=0.0, flip=False, mirror=False):
-		comp = self.components.get(shape["type"])
+		comp = self.get_component(shape["type"])
 		if comp is None:
 			raise Exception("Component '%s' does not exist!" % (shape["type"]))
 		return comp["transform"](shape, xfrom, yfrom, xto, yto, angle, flip, mirror)
 	
+	def component_groups(self, shapes, func, func_many):
+		groups = collections.OrderedDict()
+		for i in range(len(shapes)):
+			comp = self.get_component(shapes[i]["type"])
+			if comp is None:
+				raise Exception("Component '%s' does not exist!" % (shapes[i]["type"]))
+			key = (comp[func], comp[func_many])
+			if key not in groups:
+				groups[key] = []
+			groups[key].append(i)
+		return groups
+	
+	def component_transform_many(self, shapes, xfrom=0.0, yfrom=0.0, xto=0.0, yto=0.0, angle=0.0, flip=False, mirror=False):
+		
+		# group shapes by transform function
+		groups = self.component_groups(shapes, "transform", "transform_many")
+		
+		# transform each group in one go if possible
+		result = [None] * len(shapes)
+		for ((transform, transform_many), indices) in groups.items():
+			group = [shapes[i] for i in indices]
+			if transform_many is None:
+				group = [transform(shape, xfrom, yfrom, xto, yto, angle, flip, mirror) for shape in group]
+			else:
+				group = transform_many(group, xfrom, yfrom, xto, yto, angle, flip, mirror)
+			for (i, shape) in zip(indices, group):
+				result[i] = shape
+		return result
+	
 	def component_snap(self, shape, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
-		comp = self.components.get(shape["type"])
+		comp = self.get_component(shape["type"])
 		if comp is None:
 			raise Exception("Component '%s' does not exist!" % (shape["type"]))
 		return comp["snap"](shape, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
 	
+	def component_snap_many(self, shapes, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+		
+		# group shapes by snap function
+		groups = self.component_groups(shapes, "snap", "snap_many")
+		
+		# snap each group in one go if possible
+		result = [None] * len(shapes)
+		for ((snap, snap_many), indices) in groups.items():
+			group = [shapes[i] for i in indices]
+			if snap_many is None:
+				group = [snap(shape, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle) for shape in group]
+			else:
+				group = snap_many(group, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+			for (i, shape) in zip(indices, group):
+				result[i] = shape
+		return result
+	
 	def component_handles(self, shape):
-		comp = self.components.get(shape["type"])
+		comp = self.get_component(shape["type"])
 		if comp is None:
 			raise Exception("Component '%s' does not exist!" % (shape["type"]))
 		return comp["handles"](shape)
 	
 	def component_handlemove(self, shape, index, x, y):
-		comp = self.components.get(shape["type"])
+		comp = self.get_component(shape["type"])
 		if comp is None:
 			raise Exception("Component '%s' does not exist!" % (shape["type"]))
 		return comp["handlemove"](shape, index, x, y)
 	
-	def component_shapes(self, shape):
-		comp = self.components.get(shape["type"])
+	def component_lod_box(self, shape):
+		# components with many small details (such as text) that are drawn as their bounding box when they are small
+		comp = self.get_component(shape["type"])
+		if comp is None:
+			raise Exception("Component '%s' does not exist!" % (shape["type"]))
+		return comp["lod_box"]
+	
+	def component_key(self, shape):
+		comp = self.get_component(shape["type"])
 		if comp is None:
 			raise Exception("Component '%s' does not exist!" % (shape["type"]))
 		if comp["type"] == "func":
 			params = {}
 			for par in comp["params"]:
 				params[par[0]] = shape.get(par[0], par[1])
-			shapes = comp["func"](**params).shapes
+			return (shape["type"], make_hashable(params))
 		elif comp["type"] == "shapes":
-			shapes = comp["shapes"]
+			return (shape["type"],)
 		else:
 			raise Exception("Unknown type!")
-		shapes2 = []
-		for shape2 in shapes:
-			shape2 = self.component_defaults(shape2)
-			if comp["transform"] is transform_component:
-				shape2 = self.component_transform(shape2, 0.0, 0.0, shape["x"], shape["y"], shape["angle"], shape["flip"], shape["mirror"])
-			shapes2.append(shape2)
-		#print("***** SHAPES *****\n" + str(shape) + "\n----------\n" + str(shapes2))
+	
+	def component_shapes_local(self, shape):
+		key = self.component_key(shape)
+		shapes2 = self.shapes_cache.get(key)
+		if shapes2 is not None:
+			return shapes2
+		comp = self.get_component(shape["type"])
+		if comp["type"] == "func":
+			params = {}
+			for par in comp["params"]:
+				params[par[0]] = shape.get(par[0], par[1])
+			shapes = comp["func"](**params).shapes
+		else:
+			shapes = comp["shapes"]
+		shapes2 = [self.component_defaults(shape2) for shape2 in shapes]
+		self.shapes_cache.put(key, shapes2)
 		return shapes2
 	
+	def cache_stats(self):
+		return {
+			"shapes": self.shapes_cache.stats(),
+			"flat": self.flat_cache.stats(),
+		}
+	
+	def component_source_hash(self, name):
+		# Returns the hash of the source of a component as it was loaded, or None if it isn't known. This is None for
+		# components that weren't defined by a library file, or whose file was modified since it was loaded.
+		if name in self.source_hashes:
+			return self.source_hashes[name]
+		result = None
+		filename = self.lazy_components.get(name, self.component_files.get(name))
+		if filename is not None and os.path.exists(filename) and file_stamp(filename) == self.file_stamps.get(filename):
+			if self.index_cache is None:
+				self.load_index_cache()
+			entry = self.scan_file(filename)
+			if entry["hashes"] is None:
+				result = entry["hash"]
+			else:
+				result = entry["hashes"].get(name)
+		self.source_hashes[name] = result
+		return result
+	
+	def open_disk_cache(self):
+		if self.disk_cache is None:
+			self.disk_cache = False
+			if sqlite3 is None:
+				return False
+			try:
+				if not os.path.exists(os.path.dirname(self.disk_cache_file)):
+					os.makedirs(os.path.dirname(self.disk_cache_file))
+				db = sqlite3.connect(self.disk_cache_file, isolation_level=None)
+				db.execute("PRAGMA journal_mode=WAL")
+				db.execute("PRAGMA synchronous=NORMAL")
+				db.execute("CREATE TABLE IF NOT EXISTS flat (key TEXT PRIMARY KEY, deps TEXT, data BLOB, size INTEGER, used REAL)")
+				with open(__file__, "rb") as f:
+					self.core_hash = source_hash(f.read())
+				self.disk_cache_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM flat").fetchone()[0]
+				self.disk_cache = db
+			except (sqlite3.Error, IOError, OSError):
+				print("Could not open flattened component cache '%s'!" % (self.disk_cache_file))
+		return self.disk_cache
+	
+	def disk_cache_key(self, shape):
+		h = self.component_source_hash(shape["type"])
+		if h is None:
+			return None
+		return source_hash(repr((self.core_hash, h, self.component_key(shape))).encode("utf-8"))
+	
+	def disk_cache_get(self, shape):
+		db = self.open_disk_cache()
+		if not db:
+			return None
+		key = self.disk_cache_key(shape)
+		if key is None:
+			return None
+		try:
+			row = db.execute("SELECT deps, data FROM flat WHERE key = ?", (key,)).fetchone()
+			if row is None:
+				return None
+			# the entry is only valid if all components it was built from are unchanged
+			deps = json.loads(row[0])
+			for (name, h, children) in deps:
+				if self.component_source_hash(name) != h:
+					return None
+			for (name, h, children) in deps:
+				self.dependencies.setdefault(name, set()).update(children)
+			db.execute("UPDATE flat SET used = ? WHERE key = ?", (time.time(), key))
+			return marshal.loads(row[1])
+		except (sqlite3.Error, ValueError, EOFError, TypeError):
+			return None
+	
+	def disk_cache_put(self, shape, output):
+		db = self.open_disk_cache()
+		if not db:
+			return
+		key = self.disk_cache_key(shape)
+		if key is None:
+			return
+		deps = []
+		for name in sorted(self.component_closure(shape["type"])):
+			h = self.component_source_hash(name)
+			if h is None:
+				return
+			deps.append((name, h, sorted(self.dependencies.get(name, ()))))
+		try:
+			data = marshal.dumps(make_plain(output))
+			db.execute("INSERT OR REPLACE INTO flat (key, deps, data, size, used) VALUES (?, ?, ?, ?, ?)", (key, json.dumps(deps), data, len(data), time.time()))
+			self.disk_cache_bytes += len(data)
+			if self.disk_cache_bytes > self.disk_cache_size:
+				self.disk_cache_evict()
+		except (sqlite3.Error, ValueError):
+			pass
+	
+	def disk_cache_evict(self):
+		# remove the least recently used entries once the cache gets too large
+		db = self.disk_cache
+		total = db.execute("SELECT COALESCE(SUM(size), 0) FROM flat").fetchone()[0]
+		if total > self.disk_cache_size:
+			db.execute("BEGIN")
+			for (key, size) in db.execute("SELECT key, size FROM flat ORDER BY used").fetchall():
+				if total <= self.disk_cache_size * 3 // 4:
+					break
+				db.execute("DELETE FROM flat WHERE key = ?", (key,))
+				total -= size
+			db.execute("COMMIT")
+		self.disk_cache_bytes = total
+	
+	def component_flatten_local(self, shape, blacklist):
+		key = self.component_key(shape)
+		output = self.flat_cache.get(key)
+		if output is not None:
+			return output
+		output = self.disk_cache_get(shape)
+		if output is None:
+			self_references = self.self_references
+			output = []
+			blacklist.add(shape["type"])
+			for shape2 in self.component_shapes_local(shape):
+				self.add_dependency(shape["type"], shape2["type"])
+				output += self.component_flatten(shape2, blacklist=blacklist)
+			blacklist.remove(shape["type"])
+			if self.self_references != self_references: # don't cache incomplete results
+				return output
+			self.disk_cache_put(shape, output)
+		self.flat_cache.put(key, output)
+		return output
+	
 	def component_flatten(self, shape, blacklist=None):
 		if blacklist is None:
 			blacklist = set()
-		output = []
 		#shape = self.component_defaults(shape)
 		if shape["type"] in primitives:
-			output.append(shape)
-		elif shape["type"] in blacklist:
+			return [shape]
+		if shape["type"] in blacklist:
 			print("Detected self-reference in component '%s'!" % (shape["type"]))
-			#traceback.print_stack()
-		else:
-			blacklist.add(shape["type"])
-			for shape2 in self.component_shapes(shape):
-				output += self.component_flatten(shape2, blacklist=blacklist)
-			blacklist.remove(shape["type"])
-		return output
+			self.self_references += 1
+			return []
+		
+		# the component is flattened once in its own coordinate system, placement is a single transform on top of that
+		output = self.component_flatten_local(shape, blacklist)
+		comp = self.get_component(shape["type"])
+		if comp["transform"] is not transform_component:
+			return list(output)
+		if shape["x"] == 0.0 and shape["y"] == 0.0 and shape["angle"] == 0.0 and not shape["flip"] and not shape["mirror"]:
+			return list(output)
+		return self.component_transform_many(output, 0.0, 0.0, shape["x"], shape["y"], shape["angle"], shape["flip"], shape["mirror"])
 
 class Pcb:
 	
@@ -525,11 +1289,12 @@ class Pcb:
 			unknown_layers.discard(layer["name"])
 		if len(unknown_layers) != 0:
 			print("Unknown layers: " + ", ".join(unknown_layers))
+		geometry = FlatGeometry(self.shapes)
 		for layer in layerstack:
 			if layer["type"] is not None:
 				filename = path + "/" + name + "/" + name + layer["ext"]
 				if layer["type"] == "gerber":
-					self.export_gerber(layer["name"], filename, use_arcs)
+					self.export_gerber(layer["name"], filename, use_arcs, geometry)
 				elif layer["type"] == "drill":
 					self.export_drill(layer["name"], filename)
 				else:
@@ -540,13 +1305,14 @@ class Pcb:
 			os.remove(path + "/" + name + ".zip")
 		subprocess.call(["zip", "-r", name + ".zip", name], cwd=path)
 	
-	def export_gerber(self, layer, filename, use_arcs):
+	def export_gerber(self, layer, filename, use_arcs, geometry=None):
 		
+		if geometry is None:
+			geometry = FlatGeometry(self.shapes)
 		scale = 10**4 # 4.4 format, mm
 		tools = []
 		tools_circle = {}
 		tools_rectangle = {}
-		shapes_order = {}
 		toolcounter = 10 # first D-code for tools is D10
 		needs_rr = False
 		
@@ -590,9 +1356,9 @@ class Pcb:
 			return tools_rectangle[(width, height, angle)]
 		
 		def flatten_circle(x, y, radius):
-			angle = numpy.linspace(0, 2 * math.pi, 360 // circle_step, endpoint=False)
-			rx = x + radius * numpy.cos(angle)
-			ry = y + radius * numpy.sin(angle)
+			(cos_table, sin_table) = unit_circle(int(circle_steps(radius, export_tolerance)))
+			rx = x + radius * cos_table
+			ry = y + radius * sin_table
 			return (rx, ry)
 		def flatten_rectangle(x, y, width, height, angle):
 			rx = numpy.array([-width  / 2,  width  / 2,  width  / 2, -width  / 2])
@@ -648,27 +1414,42 @@ class Pcb:
 			f.write("X%sY%sD02*\n" % (ff(x1), ff(y1)))
 			f.write("X%sY%sI%sJ%sD01*\n" % (ff(x1), ff(y1), ff(x2 - x1), ff(y2 - y1)))
 		
-		# collect tools
-		for shape in self.shapes:
-			if shape["layer"] != layer:
-				continue
-			if shape["outline"] == 0.0:
-				if shape["type"] == "circle":
-					if shape["pad"]:
-						add_circle(shape["radius"] * 2)
-				elif shape["type"] == "rectangle":
-					if shape["pad"]:
-						add_rectangle(shape["width"], shape["height"], shape["angle"])
-				elif shape["type"] == "polygon":
-					pass
-				else:
-					raise Exception("Unknown shape type!")
-			else:
-				add_circle(shape["outline"])
-			order = shape["order"] * 2 + 1 if shape["hole"] else shape["order"] * 2
-			if order not in shapes_order:
-				shapes_order[order] = []
-			shapes_order[order].append(shape)
+		# collect tools (numbered in order of first use, each shape needs at most one tool)
+		tables = geometry.layers.get(layer, {})
+		tool_index = []
+		tool_circle = []
+		tool_rectangle = []
+		for (typ, table) in tables.items():
+			filled = (table["outline"] == 0.0)
+			if typ == "circle":
+				sel = filled & table["pad"]
+				tool_index.append(table["index"][sel])
+				tool_circle.append(table["radius"][sel] * 2)
+			elif typ == "rectangle":
+				sel = filled & table["pad"]
+				tool_rectangle.append((table["index"][sel], table["width"][sel], table["height"][sel], table["angle"][sel]))
+			tool_index.append(table["index"][~filled])
+			tool_circle.append(table["outline"][~filled])
+		tool_index = numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + tool_index)
+		tool_circle = numpy.concatenate([numpy.zeros(0)] + tool_circle)
+		tool_shapes = [(tool_index[i], add_circle, (tool_circle[i],)) for i in range(len(tool_index))]
+		for (index, width, height, angle) in tool_rectangle:
+			tool_shapes += [(index[i], add_rectangle, (width[i], height[i], angle[i])) for i in range(len(index))]
+		tool_shapes.sort(key=lambda tool: tool[0])
+		for (index, func, args) in tool_shapes:
+			func(*args)
+		
+		# sort shapes by order (stable, so shapes with the same order keep their original order)
+		rows = [(typ, table, numpy.arange(len(table["index"]))) for (typ, table) in tables.items()]
+		if len(rows) != 0:
+			keys = numpy.concatenate([table_order(table) for (typ, table, row) in rows])
+			indices = numpy.concatenate([table["index"] for (typ, table, row) in rows])
+			which = numpy.concatenate([numpy.full(len(row), i) for (i, (typ, table, row)) in enumerate(rows)])
+			where = numpy.concatenate([row for (typ, table, row) in rows])
+			perm = numpy.lexsort((indices, keys))
+			(keys, which, where) = (keys[perm], which[perm], where[perm])
+		else:
+			keys = []
 		
 		# write file
 		with open(filename, "w") as f:
@@ -684,52 +1465,52 @@ class Pcb:
 						f.write("%%ADD%02dR,%.4fX%.4f*%%\n" % (tool[0], tool[2] / scale, tool[3] / scale))
 					else:
 						f.write("%%ADD%02dRR,%.4fX%.4fX%.4f*%%\n" % (tool[0], tool[2] / scale, tool[3] / scale, tool[4] / scale))
-			orders = list(shapes_order.keys())
-			orders.sort()
-			for order in orders:
-				if order % 2 == 0:
-					f.write("%LPD*%\n")
-				else:
-					f.write("%LPC*%\n")
-				for shape in shapes_order[order]:
-					if shape["outline"] == 0.0:
-						if shape["type"] == "circle":
-							if shape["pad"]:
-								num = find_circle(shape["radius"] * 2)
-								write_flash(num, shape["x"], shape["y"])
-							elif use_arcs:
-								write_region_circle(shape["x"], shape["y"], shape["radius"])
-							else:
-								(rx, ry) = flatten_circle(shape["x"], shape["y"], shape["radius"])
-								write_region(rx, ry)
-						elif shape["type"] == "rectangle":
-							if shape["pad"]:
-								num = find_rectangle(shape["width"], shape["height"], shape["angle"])
-								write_flash(num, shape["x"], shape["y"])
-							else:
-								(rx, ry) = flatten_rectangle(shape["x"], shape["y"], shape["width"], shape["height"], shape["angle"])
-								write_region(rx, ry)
-						elif shape["type"] == "polygon":
-							(rx, ry) = equalize_arrays(shape["x"], shape["y"])
+			for j in range(len(keys)):
+				if j == 0 or keys[j] != keys[j - 1]:
+					if keys[j] % 2 == 0:
+						f.write("%LPD*%\n")
+					else:
+						f.write("%LPC*%\n")
+				(typ, table, row) = rows[which[j]]
+				i = where[j]
+				if table["outline"][i] == 0.0:
+					if typ == "circle":
+						if table["pad"][i]:
+							num = find_circle(table["radius"][i] * 2)
+							write_flash(num, table["x"][i], table["y"][i])
+						elif use_arcs:
+							write_region_circle(table["x"][i], table["y"][i], table["radius"][i])
+						else:
+							(rx, ry) = flatten_circle(table["x"][i], table["y"][i], table["radius"][i])
 							write_region(rx, ry)
+					elif typ == "rectangle":
+						if table["pad"][i]:
+							num = find_rectangle(table["width"][i], table["height"][i], table["angle"][i])
+							write_flash(num, table["x"][i], table["y"][i])
 						else:
-							raise Exception("Unknown shape type!")
+							(rx, ry) = flatten_rectangle(table["x"][i], table["y"][i], table["width"][i], table["height"][i], table["angle"][i])
+							write_region(rx, ry)
+					elif typ == "polygon":
+						(rx, ry) = (table["vx"][table["offset"][i]:table["offset"][i + 1]], table["vy"][table["offset"][i]:table["offset"][i + 1]])
+						write_region(rx, ry)
 					else:
-						num = find_circle(shape["outline"])
-						if shape["type"] == "circle":
-							if use_arcs:
-								write_outline_circle(num, shape["x"], shape["y"], shape["radius"])
-							else:
-								(rx, ry) = flatten_circle(shape["x"], shape["y"], shape["radius"])
-								write_outline(num, rx, ry, True)
-						elif shape["type"] == "rectangle":
-							(rx, ry) = flatten_rectangle(shape["x"], shape["y"], shape["width"], shape["height"], shape["angle"])
-							write_outline(num, rx, ry, True)
-						elif shape["type"] == "polygon":
-							(rx, ry) = equalize_arrays(shape["x"], shape["y"])
-							write_outline(num, rx, ry, shape["closed"])
+						raise Exception("Unknown shape type!")
+				else:
+					num = find_circle(table["outline"][i])
+					if typ == "circle":
+						if use_arcs:
+							write_outline_circle(num, table["x"][i], table["y"][i], table["radius"][i])
 						else:
-							raise Exception("Unknown shape type!")
+							(rx, ry) = flatten_circle(table["x"][i], table["y"][i], table["radius"][i])
+							write_outline(num, rx, ry, True)
+					elif typ == "rectangle":
+						(rx, ry) = flatten_rectangle(table["x"][i], table["y"][i], table["width"][i], table["height"][i], table["angle"][i])
+						write_outline(num, rx, ry, True)
+					elif typ == "polygon":
+						(rx, ry) = (table["vx"][table["offset"][i]:table["offset"][i + 1]], table["vy"][table["offset"][i]:table["offset"][i + 1]])
+						write_outline(num, rx, ry, table["closed"][i])
+					else:
+						raise Exception("Unknown shape type!")
 			f.write("M02*\n")
 	
 	def export_drill(self, layer, filename):
@@ -775,17 +1556,8 @@ class Pcb:
 	def export_svg(self, filename, layerstack):
 		
 		# calculate size
-		bbox_xmin = 1e99
-		bbox_xmax = -1e99
-		bbox_ymin = 1e99
-		bbox_ymax = -1e99
-		for shape in self.shapes:
-			(px, py) = shape_to_polygon(shape)
-			expand = shape["outline"] / 2
-			bbox_xmin = min(bbox_xmin, numpy.amin(px) - expand)
-			bbox_xmax = max(bbox_xmax, numpy.amax(px) + expand)
-			bbox_ymin = min(bbox_ymin, numpy.amin(py) - expand)
-			bbox_ymax = max(bbox_ymax, numpy.amax(py) + expand)
+		geometry = FlatGeometry(self.shapes)
+		(bbox_xmin, bbox_xmax, bbox_ymin, bbox_ymax) = geometry.bbox()
 		xmin = round(bbox_xmin - 1.0)
 		xmax = round(bbox_xmax + 1.0)
 		ymin = round(bbox_ymin - 1.0)
@@ -805,11 +1577,16 @@ class Pcb:
 				facecolor=(layer["color"][0], layer["color"][1], layer["color"][2], 0.3)
 				f.write("<g id=\"%s\" inkscape:groupmode=\"layer\" fill=\"%s\" fill-opacity=\"%.3f\" stroke=\"%s\" stroke-opacity=\"%.3f\" stroke-width=\"%.3fmm\">\n"
 					% (layer["name"], color_hex(facecolor), facecolor[3], color_hex(edgecolor), edgecolor[3], 0.02 * scale))
-				for shape in self.shapes:
-					if shape["layer"] != layer["name"]:
-						continue
-					(px, py) = shape_to_polygon(shape)
-					if shape["outline"] == 0.0:
+				# shapes are written in their original order, using the tessellated geometry
+				rows = []
+				for (name, typ, table) in geometry.tables([layer["name"]]):
+					polygons = geometry.polygons(name, typ, export_tolerance)
+					strokes = geometry.strokes(name, typ, export_tolerance)
+					for i in range(len(polygons)):
+						rows.append((table["index"][i], polygons[i], strokes[i]))
+				rows.sort(key=lambda row: row[0])
+				for (index, (px, py), strokes) in rows:
+					if strokes is None:
 						px = (px - xmin) * scale
 						py = (ymax - py) * scale
 						f.write("<path d=\"")
@@ -818,11 +1595,9 @@ class Pcb:
 							f.write("L%.3f,%.3f " % (px[j], py[j]))
 						f.write("Z\"/>\n")
 					else:
-						first = 1 if shape["type"] == "polygon" and not shape["closed"] else 0
-						if len(px) - first > 1:
+						if len(strokes) > 1:
 							f.write("<g>\n")
-						for i in range(first, len(px)):
-							(px2, py2) = stroke_line(px[i - 1], py[i - 1], px[i], py[i], shape["outline"])
+						for (px2, py2) in strokes:
 							px2 = (px2 - xmin) * scale
 							py2 = (ymax - py2) * scale
 							f.write("<path d=\"")
@@ -830,7 +1605,7 @@ class Pcb:
 							for j in range(1, len(px2)):
 								f.write("L%.3f,%.3f " % (px2[j], py2[j]))
 							f.write("Z\"/>\n")
-						if len(px) - first > 1:
+						if len(strokes) > 1:
 							f.write("</g>\n")
 				f.write("</g>\n")
 			f.write("</svg>\n")
@@ -842,19 +1617,64 @@ def color_hex(color):
 		max(0, min(255, int(round(color[2] * 255)))),
 	)
 
-def stroke_line(x1, y1, x2, y2, width):
-	angle = math.atan2(y2 - y1, x2 - x1) + numpy.linspace(-math.pi / 2, math.pi / 2, 180 // circle_step + 1)
+# cos/sin tables for circles and for the round caps of strokes, for each number of steps
+unit_circle_tables = {}
+unit_semicircle_tables = {}
+
+def unit_circle(steps):
+	tables = unit_circle_tables.get(steps)
+	if tables is None:
+		angle = numpy.linspace(0, 2 * math.pi, steps, endpoint=False)
+		tables = (numpy.cos(angle), numpy.sin(angle))
+		unit_circle_tables[steps] = tables
+	return tables
+
+def unit_semicircle(steps):
+	tables = unit_semicircle_tables.get(steps)
+	if tables is None:
+		angle = numpy.linspace(-math.pi / 2, math.pi / 2, steps + 1)
+		tables = (numpy.cos(angle), numpy.sin(angle))
+		unit_semicircle_tables[steps] = tables
+	return tables
+
+def circle_steps(radius, tolerance=None):
+	# Number of steps for a full circle such that the distance between the circle and the chords is at most
+	# 'tolerance'. Works on single values as well as arrays, the result is always a multiple of 4.
+	if tolerance is None:
+		return numpy.full(numpy.shape(radius), 360 // circle_step, dtype=numpy.int64)
+	radius = numpy.maximum(numpy.abs(radius), tolerance)
+	steps = numpy.ceil(math.pi / numpy.arccos(1.0 - tolerance / radius) / 4) * 4
+	return numpy.clip(steps, min_circle_steps, max_circle_steps).astype(numpy.int64)
+
+def arc_steps(radius, angle, tolerance=None):
+	# number of steps for an arc of 'angle' degrees
+	return max(1, int(math.ceil(int(circle_steps(radius, tolerance)) * abs(angle) / 360.0 - 1e-9)))
+
+def stroke_segments(x1, y1, x2, y2, width, tolerance=None):
+	# Strokes a number of line segments at once, the result has one row per segment. The cap is the unit semicircle
+	# rotated by the direction of the segment, so only one cos/sin pair per segment is needed. The width can be a
+	# single value or one value per segment, the caps are tessellated for the widest segment.
+	width = numpy.asarray(width, dtype=numpy.float64)
+	(cos_table, sin_table) = unit_semicircle(int(circle_steps(numpy.amax(width) / 2, tolerance)) // 2)
+	angle = numpy.arctan2(y2 - y1, x2 - x1)[:, None]
+	(angle_cos, angle_sin) = (numpy.cos(angle), numpy.sin(angle))
+	cx = (width / 2)[..., None] * (angle_cos * cos_table - angle_sin * sin_table)
+	cy = (width / 2)[..., None] * (angle_sin * cos_table + angle_cos * sin_table)
 	return (
-		numpy.concatenate((x1 - width / 2 * numpy.cos(angle), x2 + width / 2 * numpy.cos(angle))),
-		numpy.concatenate((y1 - width / 2 * numpy.sin(angle), y2 + width / 2 * numpy.sin(angle))),
+		numpy.concatenate((x1[:, None] - cx, x2[:, None] + cx), axis=1),
+		numpy.concatenate((y1[:, None] - cy, y2[:, None] + cy), axis=1),
 	)
 
-def shape_to_polygon(shape):
+def stroke_line(x1, y1, x2, y2, width, tolerance=None):
+	(px, py) = stroke_segments(numpy.array([x1]), numpy.array([y1]), numpy.array([x2]), numpy.array([y2]), width, tolerance)
+	return (px[0], py[0])
+
+def shape_to_polygon(shape, tolerance=None):
 	if shape["type"] == "circle":
-		angle = numpy.linspace(0, 2 * math.pi, 360 // circle_step, endpoint=False)
+		(cos_table, sin_table) = unit_circle(int(circle_steps(shape["radius"], tolerance)))
 		return (
-			shape["x"] + shape["radius"] * numpy.cos(angle),
-			shape["y"] + shape["radius"] * numpy.sin(angle),
+			shape["x"] + shape["radius"] * cos_table,
+			shape["y"] + shape["radius"] * sin_table,
 		)
 	elif shape["type"] == "rectangle":
 		rx = numpy.array([-shape["width"]  / 2,  shape["width"]  / 2,  shape["width"]  / 2, -shape["width"]  / 2])
@@ -867,3 +1687,714 @@ def shape_to_polygon(shape):
 		return equalize_arrays(shape["x"], shape["y"])
 	else:
 		raise Exception("Unknown shape type!")
+
+# Flattened shapes stored column-wise: one table per layer and per primitive type, each table is a dict of numpy
+# arrays with one element per shape. Polygon vertices are stored in a single buffer, polygon i uses vertices
+# offset[i] to offset[i + 1]. The 'index' column is the position of the shape in the original list.
+table_columns = {
+	"circle"   : ["x", "y", "radius"],
+	"rectangle": ["x", "y", "width", "height", "angle"],
+	"polygon"  : [],
+}
+
+def make_table(typ, shapes, indices):
+	shapes = [shapes[i] for i in indices]
+	table = {
+		"index"  : numpy.array(indices, dtype=numpy.int64),
+		"outline": numpy.array([shape["outline"] for shape in shapes], dtype=numpy.float64),
+		"order"  : numpy.array([shape["order"] for shape in shapes], dtype=numpy.int64),
+		"hole"   : numpy.array([shape["hole"] for shape in shapes], dtype=bool),
+		"pad"    : numpy.array([shape["pad"] for shape in shapes], dtype=bool),
+	}
+	for col in table_columns[typ]:
+		table[col] = numpy.array([shape[col] for shape in shapes], dtype=numpy.float64)
+	if typ == "polygon":
+		vertices = [equalize_arrays(shape["x"], shape["y"]) for shape in shapes]
+		table["offset"] = numpy.zeros(len(shapes) + 1, dtype=numpy.int64)
+		numpy.cumsum([len(px) for (px, py) in vertices], out=table["offset"][1:])
+		table["vx"] = numpy.concatenate([numpy.zeros(0)] + [px for (px, py) in vertices]).astype(numpy.float64)
+		table["vy"] = numpy.concatenate([numpy.zeros(0)] + [py for (px, py) in vertices]).astype(numpy.float64)
+		table["closed"] = numpy.array([shape["closed"] for shape in shapes], dtype=bool)
+	(table["xmin"], table["xmax"], table["ymin"], table["ymax"]) = table_bbox(typ, table)
+	return table
+
+def table_to_shapes(typ, layer, table):
+	# turns the rows of a table back into shape dicts, the inverse of make_table
+	columns = collections.OrderedDict()
+	for col in ["outline", "hole", "order", "pad"] + table_columns[typ]:
+		columns[col] = table[col].tolist()
+	if typ == "polygon":
+		(vx, vy, offset) = (table["vx"].tolist(), table["vy"].tolist(), table["offset"].tolist())
+		closed = table["closed"].tolist()
+	shapes = []
+	for i in range(len(table["index"])):
+		shape = {"type": typ, "layer": layer}
+		for (col, values) in columns.items():
+			shape[col] = values[i]
+		if typ == "polygon":
+			shape["x"] = vx[offset[i]:offset[i + 1]]
+			shape["y"] = vy[offset[i]:offset[i + 1]]
+			shape["closed"] = closed[i]
+		shapes.append(shape)
+	return shapes
+
+def transform_table(typ, table, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	# Same as the transform functions of the primitives, for all rows of a table at once. The result is a new table,
+	# columns that don't change are shared with the original.
+	table = table.copy()
+	if typ == "polygon":
+		(table["vx"], table["vy"]) = transform_point(table["vx"], table["vy"], xfrom, yfrom, xto, yto, angle, flip, mirror)
+	else:
+		(table["x"], table["y"]) = transform_point(table["x"], table["y"], xfrom, yfrom, xto, yto, angle, flip, mirror)
+	if typ == "rectangle":
+		if flip != mirror:
+			table["angle"] = (angle - table["angle"]) % 360.0
+		else:
+			table["angle"] = (angle + table["angle"]) % 360.0
+	(table["xmin"], table["xmax"], table["ymin"], table["ymax"]) = table_bbox(typ, table)
+	return table
+
+def table_order(table):
+	return table["order"] * 2 + table["hole"]
+
+def segment_reduce(func, values, offset, empty):
+	result = numpy.full(len(offset) - 1, empty)
+	nonempty = (offset[1:] > offset[:-1])
+	if numpy.any(nonempty):
+		result[nonempty] = func.reduceat(values, offset[:-1][nonempty])
+	return result
+
+def table_bbox(typ, table):
+	expand = table["outline"] / 2
+	if typ == "circle":
+		r = numpy.abs(table["radius"]) + expand
+		return (table["x"] - r, table["x"] + r, table["y"] - r, table["y"] + r)
+	elif typ == "rectangle":
+		angle_sin = numpy.sin(numpy.radians(table["angle"]))
+		angle_cos = numpy.cos(numpy.radians(table["angle"]))
+		w = numpy.abs(table["width"] / 2 * angle_cos) + numpy.abs(table["height"] / 2 * angle_sin) + expand
+		h = numpy.abs(table["width"] / 2 * angle_sin) + numpy.abs(table["height"] / 2 * angle_cos) + expand
+		return (table["x"] - w, table["x"] + w, table["y"] - h, table["y"] + h)
+	elif typ == "polygon":
+		return (
+			segment_reduce(numpy.minimum, table["vx"], table["offset"],  numpy.inf) - expand,
+			segment_reduce(numpy.maximum, table["vx"], table["offset"], -numpy.inf) + expand,
+			segment_reduce(numpy.minimum, table["vy"], table["offset"],  numpy.inf) - expand,
+			segment_reduce(numpy.maximum, table["vy"], table["offset"], -numpy.inf) + expand,
+		)
+	else:
+		raise Exception("Unknown shape type!")
+
+def tessellate_circles(x, y, radius, steps):
+	# tessellates N circles with the same number of steps, the result has shape (N, steps, 2)
+	(cos_table, sin_table) = unit_circle(steps)
+	return numpy.stack((
+		x[:, None] + radius[:, None] * cos_table[None, :],
+		y[:, None] + radius[:, None] * sin_table[None, :],
+	), axis=2)
+
+def tessellate_rectangles(x, y, width, height, angle):
+	# tessellates N rectangles, the result has shape (N, 4, 2)
+	rx = numpy.array([-0.5,  0.5,  0.5, -0.5])[None, :] * width[:, None]
+	ry = numpy.array([-0.5, -0.5,  0.5,  0.5])[None, :] * height[:, None]
+	angle_sin = numpy.sin(numpy.radians(angle))[:, None]
+	angle_cos = numpy.cos(numpy.radians(angle))[:, None]
+	return numpy.stack((
+		x[:, None] + rx * angle_cos - ry * angle_sin,
+		y[:, None] + rx * angle_sin + ry * angle_cos,
+	), axis=2)
+
+def table_vertices(typ, table, tolerance=None):
+	# Tessellates all shapes of a table at once. The result is a single vertex buffer (vx, vy, offset) in the same
+	# format as the vertices of a polygon table.
+	if typ == "circle":
+		steps = circle_steps(table["radius"], tolerance)
+		offset = numpy.zeros(len(steps) + 1, dtype=numpy.int64)
+		numpy.cumsum(steps, out=offset[1:])
+		vx = numpy.zeros(offset[-1])
+		vy = numpy.zeros(offset[-1])
+		# circles with the same number of steps are tessellated together
+		for n in numpy.unique(steps):
+			rows = numpy.flatnonzero(steps == n)
+			vertices = tessellate_circles(table["x"][rows], table["y"][rows], table["radius"][rows], int(n))
+			index = offset[rows, None] + numpy.arange(n)[None, :]
+			vx[index] = vertices[:, :, 0]
+			vy[index] = vertices[:, :, 1]
+		return (vx, vy, offset)
+	elif typ == "rectangle":
+		vertices = tessellate_rectangles(table["x"], table["y"], table["width"], table["height"], table["angle"])
+		offset = numpy.arange(len(vertices) + 1, dtype=numpy.int64) * 4
+		return (vertices[:, :, 0].ravel(), vertices[:, :, 1].ravel(), offset)
+	elif typ == "polygon":
+		return (table["vx"], table["vy"], table["offset"])
+	else:
+		raise Exception("Unknown shape type!")
+
+def split_vertices(vertices, rows=None):
+	(vx, vy, offset) = vertices
+	if rows is None:
+		rows = range(len(offset) - 1)
+	return [(vx[offset[i]:offset[i + 1]], vy[offset[i]:offset[i + 1]]) for i in rows]
+
+def table_to_strokes(typ, table, vertices, tolerance=None):
+	# Returns the stroked segments of each shape with an outline, or None for filled shapes. The segments of all shapes
+	# are stroked together, grouped by the number of steps of the caps. Segment j of a shape goes from vertex j - 1 to
+	# vertex j, the first segment of a closed shape connects the last vertex to the first one.
+	(vx, vy, offset) = vertices
+	strokes = [None] * (len(offset) - 1)
+	first = numpy.ones(len(offset) - 1, dtype=numpy.int64)
+	if typ == "polygon":
+		first[table["closed"]] = 0
+	else:
+		first[:] = 0
+	segments = numpy.maximum(0, offset[1:] - offset[:-1] - first)
+	outlined = numpy.flatnonzero(table["outline"] != 0.0)
+	steps = circle_steps(table["outline"][outlined] / 2, tolerance)
+	for n in numpy.unique(steps):
+		rows = outlined[steps == n]
+		count = segments[rows]
+		start = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+		numpy.cumsum(count, out=start[1:])
+		ends = numpy.repeat(offset[rows] + first[rows] - start[:-1], count) + numpy.arange(start[-1])
+		begins = ends - 1
+		wrap = (ends == numpy.repeat(offset[rows], count))
+		begins[wrap] = numpy.repeat(offset[rows + 1] - 1, count)[wrap]
+		(sx, sy) = stroke_segments(vx[begins], vy[begins], vx[ends], vy[ends], numpy.repeat(table["outline"][rows], count), tolerance)
+		for j in range(len(rows)):
+			strokes[rows[j]] = list(zip(sx[start[j]:start[j + 1]], sy[start[j]:start[j + 1]]))
+	return strokes
+
+def ring_following(offset):
+	# index of the next vertex in the same ring, for every vertex in a vertex buffer
+	following = numpy.arange(offset[-1]) + 1
+	nonempty = (offset[1:] > offset[:-1])
+	following[offset[1:][nonempty] - 1] = offset[:-1][nonempty]
+	return following
+
+def hit_test_table(typ, table, vertices, x, y, rows=None):
+	# Tests which shapes of a table contain the point (x, y), without tessellating strokes. Filled shapes use the
+	# even-odd rule on their outline, shapes with an outline are hit within half the outline width of their edges.
+	# Returns one boolean for each row.
+	(vx, vy, offset) = vertices
+	if rows is None:
+		rows = numpy.arange(len(offset) - 1)
+	counts = offset[rows + 1] - offset[rows]
+	start = numpy.cumsum(counts) - counts
+	shape = numpy.repeat(numpy.arange(len(rows)), counts)
+	position = numpy.arange(len(shape)) - start[shape]
+	index = offset[rows][shape] + position
+	following = numpy.where(position == counts[shape] - 1, offset[rows][shape], index + 1)
+	(ax, ay, bx, by) = (vx[index], vy[index], vx[following], vy[following])
+	(dx, dy) = (bx - ax, by - ay)
+	# crossing number for filled shapes
+	crossing = ((ay > y) != (by > y))
+	crossing[crossing] = (x < ax[crossing] + (y - ay[crossing]) * dx[crossing] / dy[crossing])
+	inside = (numpy.bincount(shape[crossing], minlength=len(rows)) % 2 == 1)
+	# distance to the edges for outlined shapes, open polygons don't have the closing edge
+	if typ == "polygon":
+		closed = table["closed"][rows][shape]
+	else:
+		closed = numpy.ones(len(shape), dtype=bool)
+	length = dx * dx + dy * dy
+	t = numpy.clip(((x - ax) * dx + (y - ay) * dy) / numpy.where(length > 0, length, 1.0), 0.0, 1.0)
+	distance = (ax + t * dx - x) ** 2 + (ay + t * dy - y) ** 2
+	outline = table["outline"][rows]
+	near = (distance <= (outline[shape] / 2) ** 2) & (closed | (position != counts[shape] - 1))
+	stroked = (numpy.bincount(shape[near], minlength=len(rows)) != 0)
+	return numpy.where(outline == 0.0, inside, stroked)
+
+# Polygon booleans work on integer coordinates in units of 'boolean_precision' (in mm), so all orientation tests are
+# exact. The edges of all operands are split at their intersections, then the winding number of each operand on both
+# sides of every edge is found with a sweep over x (done as a segment tree, so it runs on arrays). The edges that
+# separate the inside of the result from the outside are linked into rings.
+boolean_precision = 1e-5
+
+def orientation(ax, ay, bx, by, cx, cy):
+	# positive if c is to the left of the line from a to b
+	return (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+
+def rings_to_edges(rings):
+	lengths = numpy.array([min(len(px), len(py)) for (px, py) in rings], dtype=numpy.int64)
+	offset = numpy.zeros(len(rings) + 1, dtype=numpy.int64)
+	numpy.cumsum(lengths, out=offset[1:])
+	vx = numpy.concatenate([numpy.zeros(0)] + [numpy.asarray(px, dtype=numpy.float64)[:n] for ((px, py), n) in zip(rings, lengths)])
+	vy = numpy.concatenate([numpy.zeros(0)] + [numpy.asarray(py, dtype=numpy.float64)[:n] for ((px, py), n) in zip(rings, lengths)])
+	vx = numpy.round(vx / boolean_precision).astype(numpy.int64)
+	vy = numpy.round(vy / boolean_precision).astype(numpy.int64)
+	following = ring_following(offset)
+	(bx, by) = (vx[following], vy[following])
+	keep = (vx != bx) | (vy != by)
+	return (vx[keep], vy[keep], bx[keep], by[keep])
+
+def bbox_pairs(xmin, xmax, ymin, ymax):
+	# Returns all pairs (i, j) with i < j of which the bounding boxes overlap. The boxes are put in a uniform grid, only
+	# boxes that share a grid cell are compared.
+	count = len(xmin)
+	if count < 2:
+		return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+	(x0, y0) = (numpy.amin(xmin), numpy.amin(ymin))
+	width = max(float(numpy.amax(xmax) - x0), 1.0)
+	height = max(float(numpy.amax(ymax) - y0), 1.0)
+	size = max(math.sqrt(width * height / count), float(numpy.median(numpy.maximum(xmax - xmin, ymax - ymin))), 1.0)
+	(ix0, ix1) = (((xmin - x0) // size).astype(numpy.int64), ((xmax - x0) // size).astype(numpy.int64))
+	(iy0, iy1) = (((ymin - y0) // size).astype(numpy.int64), ((ymax - y0) // size).astype(numpy.int64))
+	# list the cells of each box
+	cells = (ix1 - ix0 + 1) * (iy1 - iy0 + 1)
+	start = numpy.cumsum(cells) - cells
+	item = numpy.repeat(numpy.arange(count), cells)
+	k = numpy.arange(len(item)) - start[item]
+	columns = (ix1 - ix0 + 1)[item]
+	cell = (ix0[item] + k % columns) * (numpy.amax(iy1) + 1) + (iy0[item] + k // columns)
+	order = numpy.argsort(cell, kind="stable")
+	(cell, item) = (cell[order], item[order])
+	# pair each box with the boxes after it in the same cell
+	end = numpy.searchsorted(cell, cell, side="right")
+	partners = end - numpy.arange(len(cell)) - 1
+	first = numpy.repeat(numpy.arange(len(cell)), partners)
+	second = first + 1 + numpy.arange(len(first)) - numpy.repeat(numpy.cumsum(partners) - partners, partners)
+	(i, j) = (numpy.minimum(item[first], item[second]), numpy.maximum(item[first], item[second]))
+	key = numpy.unique(i[i != j] * count + j[i != j])
+	(i, j) = (key // count, key % count)
+	overlap = (xmin[i] <= xmax[j]) & (xmin[j] <= xmax[i]) & (ymin[i] <= ymax[j]) & (ymin[j] <= ymax[i])
+	return (i[overlap], j[overlap])
+
+def split_edges(ax, ay, bx, by):
+	# Splits the edges at their intersections and at vertices of other edges that lie on them. Returns the new edges
+	# and the original edge of each one. Rounding the intersection points can create new intersections, so this is
+	# repeated a few times.
+	source = numpy.arange(len(ax))
+	for attempt in range(8):
+		(i, j) = bbox_pairs(numpy.minimum(ax, bx), numpy.maximum(ax, bx), numpy.minimum(ay, by), numpy.maximum(ay, by))
+		d1 = orientation(ax[i], ay[i], bx[i], by[i], ax[j], ay[j])
+		d2 = orientation(ax[i], ay[i], bx[i], by[i], bx[j], by[j])
+		d3 = orientation(ax[j], ay[j], bx[j], by[j], ax[i], ay[i])
+		d4 = orientation(ax[j], ay[j], bx[j], by[j], bx[i], by[i])
+		# proper crossings
+		cross = (numpy.sign(d1) * numpy.sign(d2) < 0) & (numpy.sign(d3) * numpy.sign(d4) < 0)
+		(ci, cj) = (i[cross], j[cross])
+		t = d3[cross] / (d3[cross] - d4[cross]).astype(numpy.float64)
+		cx = numpy.round(ax[ci] + t * (bx[ci] - ax[ci])).astype(numpy.int64)
+		cy = numpy.round(ay[ci] + t * (by[ci] - ay[ci])).astype(numpy.int64)
+		split_edge = [ci, cj]
+		split_x = [cx, cx]
+		split_y = [cy, cy]
+		# vertices on other edges
+		for (e, d, px, py) in [(i, d1, ax[j], ay[j]), (i, d2, bx[j], by[j]), (j, d3, ax[i], ay[i]), (j, d4, bx[i], by[i])]:
+			on = (d == 0)
+			split_edge.append(e[on])
+			split_x.append(px[on])
+			split_y.append(py[on])
+		split_edge = numpy.concatenate(split_edge)
+		split_x = numpy.concatenate(split_x)
+		split_y = numpy.concatenate(split_y)
+		param = (split_x - ax[split_edge]) * (bx - ax)[split_edge] + (split_y - ay[split_edge]) * (by - ay)[split_edge]
+		length = (bx - ax)[split_edge] ** 2 + (by - ay)[split_edge] ** 2
+		inside = (param > 0) & (param < length)
+		if not numpy.any(inside):
+			break
+		# insert the split points, sorted along each edge
+		edge = numpy.concatenate((numpy.arange(len(ax)), numpy.arange(len(ax)), split_edge[inside]))
+		x = numpy.concatenate((ax, bx, split_x[inside]))
+		y = numpy.concatenate((ay, by, split_y[inside]))
+		param = (x - ax[edge]) * (bx - ax)[edge] + (y - ay[edge]) * (by - ay)[edge]
+		order = numpy.lexsort((param, edge))
+		(edge, x, y) = (edge[order], x[order], y[order])
+		keep = numpy.ones(len(edge), dtype=bool)
+		keep[1:] = (edge[1:] != edge[:-1]) | (x[1:] != x[:-1]) | (y[1:] != y[:-1])
+		(edge, x, y) = (edge[keep], x[keep], y[keep])
+		link = (edge[1:] == edge[:-1])
+		(ax, ay, bx, by) = (x[:-1][link], y[:-1][link], x[1:][link], y[1:][link])
+		source = source[edge[:-1][link]]
+	return (ax, ay, bx, by, source)
+
+def merge_edges(ax, ay, bx, by, operand, count):
+	# Turns the edges into unique edges from left to right (or bottom to top). Each edge gets the change in winding
+	# number of every operand when it is crossed from right to left, edges that don't change anything are dropped.
+	flip = (ax > bx) | ((ax == bx) & (ay > by))
+	(px, py, qx, qy) = (numpy.where(flip, bx, ax), numpy.where(flip, by, ay), numpy.where(flip, ax, bx), numpy.where(flip, ay, by))
+	order = numpy.lexsort((qy, qx, py, px))
+	(px, py, qx, qy) = (px[order], py[order], qx[order], qy[order])
+	first = numpy.ones(len(px), dtype=bool)
+	first[1:] = (px[1:] != px[:-1]) | (py[1:] != py[:-1]) | (qx[1:] != qx[:-1]) | (qy[1:] != qy[:-1])
+	group = numpy.cumsum(first) - 1
+	winding = numpy.zeros((numpy.count_nonzero(first), count), dtype=numpy.int64)
+	numpy.add.at(winding, (group, operand[order]), numpy.where(flip[order], -1, 1))
+	keep = numpy.any(winding != 0, axis=1)
+	return (px[first][keep], py[first][keep], qx[first][keep], qy[first][keep], winding[keep])
+
+def sweep_winding(px, py, qx, qy, winding, sx, sy, tx, ty):
+	# Sums the winding of all edges below each query, just to the right of the start (sx, sy) of the query. The edges
+	# must go from left to right and may only touch at their end points. A query is either a point or an edge that
+	# starts at (sx, sy) and ends at (tx, ty).
+	result = numpy.zeros((len(sx), winding.shape[1]), dtype=numpy.int64)
+	if len(px) == 0:
+		return result
+	xs = numpy.unique(numpy.concatenate((px, qx)))
+	count = len(xs) - 1
+	(size, depth) = (1, 0)
+	while size < count:
+		(size, depth) = (size * 2, depth + 1)
+	# store each edge in the nodes of the segment tree that cover its x range, sorted by y
+	(l, r) = (numpy.searchsorted(xs, px) + size, numpy.searchsorted(xs, qx) + size)
+	(edge, span) = (numpy.arange(len(px)), 1)
+	(nodes, edges, middles) = ([], [], [])
+	while len(edge) != 0:
+		for side in (0, 1):
+			if side == 0:
+				take = (l % 2 == 1)
+				k = l[take]
+				l = l + take
+			else:
+				take = (r % 2 == 1)
+				r = r - take
+				k = r[take]
+			a = k * span - size
+			nodes.append(k)
+			edges.append(edge[take])
+			middles.append((xs[a] + xs[a + span]) / 2)
+		(l, r, span) = (l // 2, r // 2, span * 2)
+		alive = (l < r)
+		(edge, l, r) = (edge[alive], l[alive], r[alive])
+	node = numpy.concatenate(nodes)
+	edge = numpy.concatenate(edges)
+	middle = numpy.concatenate(middles)
+	height = py[edge] + (middle - px[edge]) * (qy - py)[edge] / (qx - px)[edge]
+	order = numpy.lexsort((height, node))
+	(node, edge) = (node[order], edge[order])
+	cumulative = numpy.zeros((len(edge) + 1, winding.shape[1]), dtype=numpy.int64)
+	numpy.cumsum(winding[edge], axis=0, out=cumulative[1:])
+	# walk from the leaf of each query to the root, and count the edges below it in every node
+	interval = numpy.searchsorted(xs, sx, side="right") - 1
+	query = numpy.flatnonzero((interval >= 0) & (interval < count))
+	leaf = interval[query] + size
+	(sx, sy, tx, ty) = (sx[query], sy[query], tx[query], ty[query])
+	for level in range(depth + 1):
+		k = leaf >> level
+		start = numpy.searchsorted(node, k, side="left")
+		(lo, hi) = (start, numpy.searchsorted(node, k, side="right"))
+		active = (lo < hi)
+		while numpy.any(active):
+			mid = numpy.minimum((lo + hi) // 2, len(edge) - 1)
+			e = edge[mid]
+			s = orientation(px[e], py[e], qx[e], qy[e], sx, sy)
+			s = numpy.where(s == 0, orientation(px[e], py[e], qx[e], qy[e], tx, ty), s)
+			below = (s > 0)
+			lo = numpy.where(active & below, mid + 1, lo)
+			hi = numpy.where(active & ~below, mid, hi)
+			active = (lo < hi)
+		result[query] += cumulative[lo] - cumulative[start]
+	return result
+
+def point_in_ring(ax, ay, bx, by, x, y):
+	# even-odd test for a point that is not on the ring
+	crossing = (ay > y) != (by > y)
+	s = orientation(ax[crossing], ay[crossing], bx[crossing], by[crossing], x, y)
+	return (numpy.count_nonzero((s > 0) == (by[crossing] > ay[crossing])) % 2 == 1)
+
+def link_rings(sx, sy, ex, ey):
+	# Links directed edges into rings, and finds the outline that contains each hole.
+	count = len(sx)
+	points = numpy.stack((numpy.concatenate((sx, ex)), numpy.concatenate((sy, ey))), axis=1)
+	(unique, inverse) = numpy.unique(points, axis=0, return_inverse=True)
+	inverse = inverse.reshape(-1)
+	(start, end) = (inverse[:count], inverse[count:])
+	order = numpy.argsort(start, kind="stable")
+	first = numpy.searchsorted(start[order], numpy.arange(len(unique)))
+	degree = numpy.bincount(start, minlength=len(unique))
+	following = order[numpy.minimum(first[end], count - 1)]
+	# Where rings touch, pick the outgoing edge with the smallest clockwise turn from the reversed incoming edge, this
+	# keeps the rings separate.
+	for e in numpy.flatnonzero(degree[end] > 1):
+		candidates = order[first[end[e]]:first[end[e]] + degree[end[e]]]
+		back = math.atan2(sy[e] - ey[e], sx[e] - ex[e])
+		angles = numpy.arctan2(ey[candidates] - sy[candidates], ex[candidates] - sx[candidates])
+		following[e] = candidates[numpy.argmin((back - angles) % (2 * math.pi))]
+	visited = numpy.zeros(count, dtype=bool)
+	following = following.tolist()
+	rings = []
+	for e in range(count):
+		ring = []
+		while not visited[e]:
+			visited[e] = True
+			ring.append(e)
+			e = following[e]
+		if len(ring) != 0:
+			rings.append(numpy.array(ring))
+	# signed area and bounding box of each ring
+	areas = numpy.array([numpy.sum(sx[ring] * ey[ring] - ex[ring] * sy[ring]) / 2 for ring in rings])
+	bboxes = numpy.array([(numpy.amin(sx[ring]), numpy.amax(sx[ring]), numpy.amin(sy[ring]), numpy.amax(sy[ring])) for ring in rings]).reshape(-1, 4)
+	# the parent of a hole is the smallest outline that contains the middle of one of its edges
+	parents = numpy.full(len(rings), -1, dtype=numpy.int64)
+	outlines = numpy.flatnonzero(areas > 0)
+	outlines = outlines[numpy.argsort(areas[outlines], kind="stable")]
+	for h in numpy.flatnonzero(areas < 0):
+		e = rings[h][0]
+		(x, y) = (sx[e] + ex[e], sy[e] + ey[e])
+		candidates = outlines[(2 * bboxes[outlines, 0] <= x) & (2 * bboxes[outlines, 1] >= x) & (2 * bboxes[outlines, 2] <= y) & (2 * bboxes[outlines, 3] >= y)]
+		for c in candidates:
+			ring = rings[c]
+			if point_in_ring(2 * sx[ring], 2 * sy[ring], 2 * ex[ring], 2 * ey[ring], x, y):
+				parents[h] = c
+				break
+	# drop vertices in the middle of straight edges
+	result = []
+	for ring in rings:
+		(x, y) = (sx[ring], sy[ring])
+		straight = (orientation(numpy.roll(x, 1), numpy.roll(y, 1), x, y, numpy.roll(x, -1), numpy.roll(y, -1)) == 0)
+		result.append((x[~straight] * boolean_precision, y[~straight] * boolean_precision))
+	return (result, parents)
+
+def polygon_boolean(operands, func, rule="nonzero"):
+	# Combines several lists of rings. 'func' gets a boolean array with one row per region and one column per operand,
+	# which tells whether the region is inside each operand, and returns whether the region is part of the result.
+	# Returns a list of rings (counterclockwise outlines and clockwise holes) and the outline that contains each hole
+	# (-1 for outlines).
+	if rule == "nonzero":
+		fill = lambda winding: (winding != 0)
+	elif rule == "evenodd":
+		fill = lambda winding: (winding % 2 != 0)
+	else:
+		raise Exception("Unknown fill rule!")
+	edges = [rings_to_edges(rings) for rings in operands]
+	(ax, ay, bx, by) = [numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + [edge[i] for edge in edges]) for i in range(4)]
+	operand = numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + [numpy.full(len(edges[k][0]), k, dtype=numpy.int64) for k in range(len(edges))])
+	(ax, ay, bx, by, source) = split_edges(ax, ay, bx, by)
+	(px, py, qx, qy, winding) = merge_edges(ax, ay, bx, by, operand[source], len(operands))
+	if len(px) == 0:
+		return ([], numpy.zeros(0, dtype=numpy.int64))
+	# The winding on the right side of each edge is that of the edges below it (just to the right of vertical edges),
+	# crossing the edge adds its own winding. Coordinates are doubled so the middle of vertical edges is exact.
+	vertical = (px == qx)
+	right = sweep_winding(2 * px[~vertical], 2 * py[~vertical], 2 * qx[~vertical], 2 * qy[~vertical], winding[~vertical],
+		2 * px, numpy.where(vertical, py + qy, 2 * py), numpy.where(vertical, 2 * px, 2 * qx), numpy.where(vertical, py + qy, 2 * qy))
+	inside_left = numpy.asarray(func(fill(right + winding)), dtype=bool)
+	inside_right = numpy.asarray(func(fill(right)), dtype=bool)
+	# orient the boundary edges so the inside is on the left
+	keep = (inside_left != inside_right)
+	forward = inside_left[keep]
+	(px, py, qx, qy) = (px[keep], py[keep], qx[keep], qy[keep])
+	if len(px) == 0:
+		return ([], numpy.zeros(0, dtype=numpy.int64))
+	return link_rings(numpy.where(forward, px, qx), numpy.where(forward, py, qy), numpy.where(forward, qx, px), numpy.where(forward, qy, py))
+
+def polygon_union(rings, rule="nonzero"):
+	return polygon_boolean([rings], lambda inside: inside[:, 0], rule)
+
+def polygon_intersection(rings1, rings2, rule="nonzero"):
+	return polygon_boolean([rings1, rings2], lambda inside: inside[:, 0] & inside[:, 1], rule)
+
+def polygon_difference(rings1, rings2, rule="nonzero"):
+	return polygon_boolean([rings1, rings2], lambda inside: inside[:, 0] & ~inside[:, 1], rule)
+
+def polygon_area(rings):
+	# total area, holes are counted as negative
+	return sum(numpy.sum(px * numpy.roll(py, -1) - numpy.roll(px, -1) * py) / 2 for (px, py) in rings)
+
+def layer_fill(dark):
+	# The shapes of a layer are drawn in order, so a region belongs to the result if the last operand that covers it
+	# is not a hole.
+	dark = numpy.asarray(dark, dtype=bool)
+	def func(inside):
+		last = inside.shape[1] - 1 - numpy.argmax(inside[:, ::-1], axis=1)
+		return numpy.any(inside, axis=1) & dark[last]
+	return func
+
+class FlatGeometry:
+	
+	def __init__(self, shapes=None, layers=None):
+		# The geometry is stored only as tables, the shape dicts are not kept. The tables are built from a list of
+		# shapes, or given directly as a dict of layers with a dict of tables each.
+		self.layer_bboxes = {}
+		self.vertex_cache = {}
+		self.polygon_cache = {}
+		self.stroke_cache = {}
+		if layers is None:
+			layers = collections.OrderedDict()
+			groups = collections.OrderedDict()
+			for i in range(len(shapes)):
+				key = (shapes[i]["layer"], shapes[i]["type"])
+				if key not in groups:
+					groups[key] = []
+				groups[key].append(i)
+			for ((layer, typ), indices) in groups.items():
+				if layer not in layers:
+					layers[layer] = collections.OrderedDict()
+				layers[layer][typ] = make_table(typ, shapes, indices)
+		self.layers = layers
+		self.count = sum(len(table["index"]) for (layer, typ, table) in self.tables())
+		# bounding box of each layer, the bounding boxes of the shapes are stored in the tables
+		for (layer, typ, table) in self.tables():
+			(xmin, xmax, ymin, ymax) = self.layer_bboxes.get(layer, (1e99, -1e99, 1e99, -1e99))
+			self.layer_bboxes[layer] = (
+				min(xmin, numpy.amin(table["xmin"])),
+				max(xmax, numpy.amax(table["xmax"])),
+				min(ymin, numpy.amin(table["ymin"])),
+				max(ymax, numpy.amax(table["ymax"])),
+			)
+	
+	def tables(self, layers=None):
+		for (layer, tables) in self.layers.items():
+			if layers is None or layer in layers:
+				for (typ, table) in tables.items():
+					yield (layer, typ, table)
+	
+	def to_shapes(self):
+		# returns the shapes as new dicts in their original order, for code that needs them in that form
+		shapes = [None] * self.count
+		for (layer, typ, table) in self.tables():
+			for (i, shape) in zip(table["index"].tolist(), table_to_shapes(typ, layer, table)):
+				shapes[i] = shape
+		return shapes
+	
+	def transform(self, xfrom, yfrom, xto, yto, angle, flip, mirror):
+		# Returns a transformed copy. This object isn't changed, the undo history of the editor may still use it.
+		layers = collections.OrderedDict()
+		for (layer, typ, table) in self.tables():
+			if flip:
+				layer = flip_layer(layer)
+			if layer not in layers:
+				layers[layer] = collections.OrderedDict()
+			layers[layer][typ] = transform_table(typ, table, xfrom, yfrom, xto, yto, angle, flip, mirror)
+		return FlatGeometry(layers=layers)
+	
+	def tables_bbox(self, xmin, xmax, ymin, ymax, layers=None):
+		# like tables, but skips layers that don't overlap the rectangle and also returns the overlapping rows
+		for (layer, tables) in self.layers.items():
+			if layers is not None and layer not in layers:
+				continue
+			(bxmin, bxmax, bymin, bymax) = self.layer_bboxes[layer]
+			if bxmin > xmax or bxmax < xmin or bymin > ymax or bymax < ymin:
+				continue
+			for (typ, table) in tables.items():
+				rows = numpy.flatnonzero((table["xmin"] <= xmax) & (table["xmax"] >= xmin) & (table["ymin"] <= ymax) & (table["ymax"] >= ymin))
+				if len(rows) != 0:
+					yield (layer, typ, table, rows)
+	
+	# Tessellated geometry is computed on first use and kept for the lifetime of the object, flattened shapes don't
+	# change after they are created. Only the tessellation for the last tolerance is kept, rectangles and polygons
+	# don't depend on the tolerance at all.
+	
+	def vertices(self, layer, typ, tolerance=None):
+		key = (layer, typ)
+		if typ != "circle":
+			tolerance = None
+		(cached_tolerance, result) = self.vertex_cache.get(key, (None, None))
+		if result is None or cached_tolerance != tolerance:
+			result = table_vertices(typ, self.layers[layer][typ], tolerance)
+			self.vertex_cache[key] = (tolerance, result)
+		return result
+	
+	def polygons(self, layer, typ, tolerance=None):
+		key = (layer, typ)
+		if typ != "circle":
+			tolerance = None
+		(cached_tolerance, result) = self.polygon_cache.get(key, (None, None))
+		if result is None or cached_tolerance != tolerance:
+			result = split_vertices(self.vertices(layer, typ, tolerance))
+			self.polygon_cache[key] = (tolerance, result)
+		return result
+	
+	def strokes(self, layer, typ, tolerance=None):
+		key = (layer, typ)
+		(cached_tolerance, result) = self.stroke_cache.get(key, (None, None))
+		if result is None or cached_tolerance != tolerance:
+			result = table_to_strokes(typ, self.layers[layer][typ], self.vertices(layer, typ, tolerance), tolerance)
+			self.stroke_cache[key] = (tolerance, result)
+		return result
+	
+	def shapes_at(self, x, y, layers=None, tolerance=None):
+		# returns the indices of the shapes that contain the point, only shapes with a matching bounding box are tested
+		result = []
+		for (layer, typ, table) in self.tables(layers):
+			rows = numpy.flatnonzero((table["xmin"] <= x) & (table["xmax"] >= x) & (table["ymin"] <= y) & (table["ymax"] >= y))
+			if len(rows) != 0:
+				hit = hit_test_table(typ, table, self.vertices(layer, typ, tolerance), x, y, rows)
+				result.append(table["index"][rows[hit]])
+		return numpy.sort(numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + result))
+	
+	def resolve(self, layer, tolerance=export_tolerance):
+		# Resolves the order and hole flags of the shapes on a layer into the final polygons, see polygon_boolean.
+		levels = {}
+		for (name, typ, table) in self.tables([layer]):
+			polygons = self.polygons(name, typ, tolerance)
+			strokes = self.strokes(name, typ, tolerance)
+			keys = table_order(table)
+			for i in range(len(polygons)):
+				levels.setdefault(int(keys[i]), []).extend([polygons[i]] if strokes[i] is None else strokes[i])
+		keys = sorted(levels)
+		return polygon_boolean([levels[key] for key in keys], layer_fill([key % 2 == 0 for key in keys]))
+	
+	def bbox(self, layers=None):
+		(xmin, xmax, ymin, ymax) = (1e99, -1e99, 1e99, -1e99)
+		for (layer, (bxmin, bxmax, bymin, bymax)) in self.layer_bboxes.items():
+			if layers is None or layer in layers:
+				xmin = min(xmin, bxmin)
+				xmax = max(xmax, bxmax)
+				ymin = min(ymin, bymin)
+				ymax = max(ymax, bymax)
+		return (xmin, xmax, ymin, ymax)
+
+class GridIndex:
+	
+	# Uniform grid of bounding boxes, used to find the items near a point or in a rectangle without looking at all of
+	# them. Items that would cover too many cells are kept in a separate set that is always checked.
+	max_cells = 64
+	
+	def __init__(self, cell_size):
+		self.cell_size = cell_size
+		self.cells = {}
+		self.bboxes = {}
+		self.large = set()
+	
+	def cell_range(self, xmin, xmax, ymin, ymax):
+		return (
+			int(math.floor(xmin / self.cell_size)),
+			int(math.floor(xmax / self.cell_size)),
+			int(math.floor(ymin / self.cell_size)),
+			int(math.floor(ymax / self.cell_size)),
+		)
+	
+	def insert(self, item, bbox):
+		(xmin, xmax, ymin, ymax) = bbox
+		if xmin > xmax or ymin > ymax:
+			return # empty items are never found
+		self.bboxes[item] = bbox
+		(ix0, ix1, iy0, iy1) = self.cell_range(xmin, xmax, ymin, ymax)
+		if (ix1 - ix0 + 1) * (iy1 - iy0 + 1) > self.max_cells:
+			self.large.add(item)
+			return
+		for ix in range(ix0, ix1 + 1):
+			for iy in range(iy0, iy1 + 1):
+				self.cells.setdefault((ix, iy), set()).add(item)
+	
+	def remove(self, item):
+		bbox = self.bboxes.pop(item, None)
+		if bbox is None:
+			return
+		if item in self.large:
+			self.large.remove(item)
+			return
+		(ix0, ix1, iy0, iy1) = self.cell_range(*bbox)
+		for ix in range(ix0, ix1 + 1):
+			for iy in range(iy0, iy1 + 1):
+				cell = self.cells[(ix, iy)]
+				cell.discard(item)
+				if len(cell) == 0:
+					del self.cells[(ix, iy)]
+	
+	def query(self, xmin, xmax, ymin, ymax):
+		# returns the items of which the bounding box overlaps the rectangle
+		(ix0, ix1, iy0, iy1) = self.cell_range(xmin, xmax, ymin, ymax)
+		if (ix1 - ix0 + 1) * (iy1 - iy0 + 1) > len(self.cells):
+			candidates = self.bboxes.keys()
+		else:
+			candidates = set(self.large)
+			for ix in range(ix0, ix1 + 1):
+				for iy in range(iy0, iy1 + 1):
+					candidates.update(self.cells.get((ix, iy), ()))
+		result = []
+		for item in candidates:
+			(bxmin, bxmax, bymin, bymax) = self.bboxes[item]
+			if bxmin <= xmax and bxmax >= xmin and bymin <= ymax and bymax >= ymin:
+				result.append(item)
+		return result
@@ -8,21 +8,22 @@ import math
 import numpy
 import os
 import sys
-from PySide.QtCore import Qt, QSize, QPointF
+from PySide.QtCore import Qt, QSize, QPointF, QRectF
 from PySide.QtGui import QApplication, QMainWindow, QWidget, QMenu
 from PySide.QtGui import QHBoxLayout, QVBoxLayout, QGridLayout, QSizePolicy
 from PySide.QtGui import QLabel, QPushButton, QLineEdit, QSplitter, QScrollArea, QTextBrowser
 from PySide.QtGui import QClipboard, QShortcut, QKeySequence, QFileDialog, QInputDialog, QDialog
-from PySide.QtGui import QPainter, QImage, QPen, QBrush, QColor, QFont, QPolygonF
+from PySide.QtGui import QPainter, QPainterPath, QPainterPathStroker, QImage, QPen, QBrush, QColor, QFont, QPolygonF
 
 import time
 
 class Instance:
-	def __init__(self, shape, selected, flat, handles):
+	def __init__(self, shape, selected, handles, geometry):
 		self.shape = shape
 		self.selected = selected
-		self.flat = flat
 		self.handles = handles
+		self.geometry = geometry
+		self.bbox = geometry.bbox()
 
 class History:
 	def __init__(self, instances, soft):
@@ -32,6 +33,7 @@ class History:
 class Component:
 	
 	max_history = 20
+	index_cell_size = 2.0
 	
 	def __init__(self, name, instances, view_x=None, view_y=None, view_scale=None, grid_origin_x=None, grid_origin_y=None, grid_angle=None, grid_step_x=None, grid_step_y=None):
 		
@@ -48,6 +50,129 @@ class Component:
 		
 		# initialize history
 		self.history_clear()
+		
+		# initialize spatial index
+		self.index_clear()
+		
+		# initialize display lists
+		self.display_clear()
+	
+	def index_clear(self):
+		self.index = alterpcb_core.GridIndex(self.index_cell_size)
+		self.index_instances = []
+		self.index_positions = {}
+	
+	def get_index(self):
+		# The index contains the geometry of the instances rather than the instances themselves. Changing the selection
+		# replaces the Instance objects but keeps their geometry, and geometry is never changed in place (except during a
+		# reload, which clears the index), so only geometry that was added or removed has to be handled. The positions
+		# map each geometry back to the instances that use it.
+		if self.index_instances is not self.instances:
+			positions = {}
+			for (i, inst) in enumerate(self.instances):
+				positions.setdefault(inst.geometry, []).append(i)
+			for geometry in self.index_positions.keys() - positions.keys():
+				self.index.remove(geometry)
+			for geometry in positions.keys() - self.index_positions.keys():
+				self.index.insert(geometry, self.instances[positions[geometry][0]].bbox)
+			self.index_instances = self.instances
+			self.index_positions = positions
+		return self.index
+	
+	def get_instances_bbox(self, xmin, xmax, ymin, ymax):
+		# returns the instances of which the bounding box overlaps the rectangle, in their original order
+		index = self.get_index()
+		positions = []
+		for geometry in index.query(xmin, xmax, ymin, ymax):
+			positions += self.index_positions[geometry]
+		return [self.instances[i] for i in sorted(positions)]
+	
+	def display_clear(self):
+		self.display = {}
+		self.display_instances = []
+	
+	def get_display(self, geometry, layer, typ, paths=False):
+		# Returns the display list of one table of the geometry of an instance as a dict. "keys" contains the drawing
+		# order of each row, "groups" maps each order to its rows and the None group contains all rows. "size" is the
+		# largest side of the bounding box of each row and "group_sizes" the smallest size in each group, they are
+		# used for the level of detail. Display lists are keyed on the geometry, which is shared by instances that only
+		# differ in selection, and kept until no instance uses the geometry, so changing the selection, moving the
+		# cursor or editing a few instances doesn't rebuild the display lists of all the others.
+		if self.display_instances is not self.instances:
+			new = set(inst.geometry for inst in self.instances)
+			for old in [old for old in self.display if old not in new]:
+				del self.display[old]
+			self.display_instances = self.instances
+		tables = self.display.setdefault(geometry, {})
+		display = tables.get((layer, typ))
+		if display is None:
+			table = geometry.layers[layer][typ]
+			keys = alterpcb_core.table_order(table)
+			size = numpy.maximum(table["xmax"] - table["xmin"], table["ymax"] - table["ymin"])
+			orders = numpy.unique(keys).tolist()
+			groups = {None: numpy.arange(len(keys))}
+			if len(orders) > 1:
+				for order in orders:
+					groups[order] = numpy.flatnonzero(keys == order)
+			else:
+				groups[orders[0]] = groups[None]
+			display = {
+				"keys": keys,
+				"orders": orders,
+				"groups": groups,
+				"size": size,
+				"group_sizes": {group: numpy.min(size[rows]) for (group, rows) in groups.items()},
+				"items": None,
+				"paths": None,
+			}
+			tables[(layer, typ)] = display
+		
+		# The paths are built when the table is first drawn at full detail. Element i of "items" is (outlined, path) for
+		# row i, "paths" maps each group to the (fill, stroke) paths that combine its rows without and with an outline.
+		# Filled circles are added as ellipses and outlines are stroked by Qt with round caps and joins, so nothing is
+		# tessellated and the paths don't depend on the zoom level. Filled polygons are made counterclockwise, see
+		# LayoutViewer.draw_tables.
+		if paths and display["items"] is None:
+			table = geometry.layers[layer][typ]
+			if typ != "circle":
+				polygons = alterpcb_core.split_vertices(geometry.vertices(layer, typ))
+			stroker = QPainterPathStroker()
+			stroker.setCapStyle(Qt.RoundCap)
+			stroker.setJoinStyle(Qt.RoundJoin)
+			items = []
+			for i in range(len(table["index"])):
+				outlined = (table["outline"][i] != 0.0)
+				path = QPainterPath()
+				path.setFillRule(Qt.WindingFill)
+				if typ == "circle":
+					radius = abs(table["radius"][i])
+					path.addEllipse(QPointF(table["x"][i], table["y"][i]), radius, radius)
+				else:
+					(px, py) = polygons[i]
+					if not outlined and alterpcb_core.polygon_area([(px, py)]) < 0.0:
+						(px, py) = (px[::-1], py[::-1])
+					path.addPolygon(QPolygonF([QPointF(px[j], py[j]) for j in range(len(px))]))
+					if typ != "polygon" or table["closed"][i]:
+						path.closeSubpath()
+				if outlined:
+					stroker.setWidth(abs(table["outline"][i]))
+					path = stroker.createStroke(path)
+				items.append((outlined, path))
+			combined = {}
+			for (group, rows) in display["groups"].items():
+				if group is not None and rows is display["groups"][None]:
+					combined[group] = combined[None]
+					continue
+				fill = QPainterPath()
+				fill.setFillRule(Qt.WindingFill)
+				stroke = QPainterPath()
+				stroke.setFillRule(Qt.WindingFill)
+				for i in rows:
+					(fill if not items[i][0] else stroke).addPath(items[i][1])
+				combined[group] = (fill, stroke)
+			display["items"] = items
+			display["paths"] = combined
+		return display
 	
 	def history_clear(self):
 		self.history_instances = [History(self.instances, False)]
@@ -100,6 +225,14 @@ class LayoutViewer(QWidget):
 	quality_high = 2
 	quality_count = 3
 	
+	# maximum chord error of tessellated curves, in pixels
+	tessellation_error = 0.25
+	
+	# Level of detail, indexed by quality: shapes smaller than 'lod_shape_size' pixels are drawn as their bounding box,
+	# text instances lower than 'lod_text_size' pixels are drawn as one bounding box per layer.
+	lod_shape_size = [4.0, 2.0, 1.0]
+	lod_text_size = [12.0, 6.0, 3.0]
+	
 	layer_mode_all = 0
 	layer_mode_half = 1
 	layer_mode_single = 2
@@ -194,19 +327,31 @@ class LayoutViewer(QWidget):
 		self.helpdialog = HelpDialog(self.shortcuts)
 		self.helpdialog.show()
 	
-	def load_library(self):
-		self.library = alterpcb_core.Library()
+	def library_files(self):
+		filenames = []
 		for path in sys.argv[1:]:
 			if path.endswith("/"):
 				path = path[:-1]
-			for filename in os.listdir(path):
-				if filename.endswith(".alterlib.json"):
-					print("Loading '" + path + "/" + filename + "' ...")
-					self.library.load_json(path + "/" + filename)
-				if filename.endswith(".alterlib.py"):
-					print("Loading '" + path + "/" + filename + "' ...")
-					self.library.load_python(path + "/" + filename)
-		print("Libraries loaded.")
+			for filename in sorted(os.listdir(path)):
+				if filename.endswith(".alterlib.json") or filename.endswith(".alterlib.py"):
+					filenames.append(path + "/" + filename)
+		return filenames
+	
+	def load_processes(self):
+		# empty or invalid values use no worker processes, negative values are treated as zero
+		value = os.environ.get("ALTERPCB_LOAD_PROCESSES")
+		if value is None:
+			return 0
+		try:
+			return max(0, int(value))
+		except ValueError:
+			print("Invalid value '%s' for ALTERPCB_LOAD_PROCESSES, libraries will be scanned without worker processes!" % (value))
+			return 0
+	
+	def load_library(self):
+		self.library = alterpcb_core.Library()
+		self.library.index_files(self.library_files(), self.load_processes())
+		print("Libraries indexed.")
 	
 	def update_title(self):
 		if self.file_name is None:
@@ -219,14 +364,33 @@ class LayoutViewer(QWidget):
 	
 	def make_instance(self, shape, selected, source=None):
 		if source is None:
-			return Instance(shape, selected, self.library.component_flatten(shape), self.library.component_handles(shape))
+			geometry = alterpcb_core.FlatGeometry(self.library.component_flatten(shape))
+			return Instance(shape, selected, self.library.component_handles(shape), geometry)
 		else:
-			return Instance(shape, selected, source.flat, source.handles)
+			return Instance(shape, selected, source.handles, source.geometry)
+	
+	def transform_instances(self, instances, xfrom, yfrom, xto, yto, angle, flip, mirror):
+		# flattening commutes with transformations, so the flattened geometry can be transformed directly
+		# the shapes of the selected instances are transformed as a single batch, the geometry one table at a time
+		shapes = [inst.shape for inst in instances if inst.selected]
+		shapes = self.library.component_transform_many(shapes, xfrom, yfrom, xto, yto, angle, flip, mirror)
+		newinstances = []
+		pos = 0
+		for inst in instances:
+			if inst.selected:
+				shape = shapes[pos]
+				pos += 1
+				geometry = inst.geometry.transform(xfrom, yfrom, xto, yto, angle, flip, mirror)
+				newinstances.append(Instance(shape, True, self.library.component_handles(shape), geometry))
+			else:
+				newinstances.append(inst)
+		return newinstances
 	
 	def update_instance(self, inst):
 		inst.shape = self.library.component_defaults(inst.shape)
-		inst.flat = self.library.component_flatten(inst.shape)
 		inst.handles = self.library.component_handles(inst.shape)
+		inst.geometry = alterpcb_core.FlatGeometry(self.library.component_flatten(inst.shape))
+		inst.bbox = inst.geometry.bbox()
 	
 	def load_blank(self):
 		
@@ -316,6 +480,14 @@ class LayoutViewer(QWidget):
 			comp.view_y - (y - self.height() / 2) / comp.view_scale,
 		)
 	
+	def view_tolerance(self):
+		# The tolerance is rounded down to a power of two, so the tessellated geometry is only recalculated when the
+		# zoom level changes by a factor of two. It is never finer than the export tolerance.
+		assert(self.has_component())
+		comp = self.get_component()
+		tolerance = 2.0 ** math.floor(math.log2(self.tessellation_error / comp.view_scale))
+		return max(alterpcb_core.export_tolerance, tolerance)
+	
 	def pcb_to_screen(self, x, y):
 		assert(self.has_component())
 		comp = self.get_component()
@@ -405,27 +577,10 @@ class LayoutViewer(QWidget):
 		layers_active = set()
 		for i in range(layers_suppressed, len(layers_ordered)):
 			layers_active.add(layers_ordered[i]["name"])
+		tolerance = self.view_tolerance()
 		results = []
-		for inst in comp.instances:
-			hit = False
-			for shape in inst.flat:
-				if shape["layer"] not in layers_active:
-					continue
-				(px, py) = alterpcb_core.shape_to_polygon(shape)
-				if shape["outline"] == 0.0:
-					poly = QPolygonF([QPointF(px[i], py[i]) for i in range(len(px))])
-					if poly.containsPoint(QPointF(x, y), Qt.OddEvenFill):
-						hit = True
-						break
-				else:
-					first = 1 if shape["type"] == "polygon" and not shape["closed"] else 0
-					for i in range(first, len(px)):
-						(px2, py2) = alterpcb_core.stroke_line(px[i - 1], py[i - 1], px[i], py[i], shape["outline"])
-						poly = QPolygonF([QPointF(px2[i], py2[i]) for i in range(len(px2))])
-						if poly.containsPoint(QPointF(x, y), Qt.OddEvenFill):
-							hit = True
-							break
-			if hit:
+		for inst in comp.get_instances_bbox(x, x, y, y):
+			if len(inst.geometry.shapes_at(x, y, layers_active, tolerance)) != 0:
 				results.append(inst)
 		if len(results) > 1:
 			menu = QMenu()
@@ -459,20 +614,9 @@ class LayoutViewer(QWidget):
 		for i in range(layers_suppressed, len(layers_ordered)):
 			layers_active.add(layers_ordered[i]["name"])
 		results = []
-		for inst in comp.instances:
-			bbox_xmin = 1e99
-			bbox_xmax = -1e99
-			bbox_ymin = 1e99
-			bbox_ymax = -1e99
-			for shape in inst.flat:
-				if shape["layer"] not in layers_active:
-					continue
-				(px, py) = alterpcb_core.shape_to_polygon(shape)
-				expand = shape["outline"] / 2
-				bbox_xmin = min(bbox_xmin, numpy.amin(px) - expand)
-				bbox_xmax = max(bbox_xmax, numpy.amax(px) + expand)
-				bbox_ymin = min(bbox_ymin, numpy.amin(py) - expand)
-				bbox_ymax = max(bbox_ymax, numpy.amax(py) + expand)
+		# instances that don't touch the rectangle at all can be skipped without looking at the layers
+		for inst in comp.get_instances_bbox(xmin, xmax, ymin, ymax):
+			(bbox_xmin, bbox_xmax, bbox_ymin, bbox_ymax) = inst.geometry.bbox(layers_active)
 			if bbox_xmin <= bbox_xmax and bbox_ymin <= bbox_ymax and bbox_xmin >= xmin and bbox_xmax <= xmax and bbox_ymin >= ymin and bbox_ymax <= ymax:
 				results.append(inst)
 		return results
@@ -493,14 +637,7 @@ class LayoutViewer(QWidget):
 	def transform_selection(self, xfrom=0.0, yfrom=0.0, xto=0.0, yto=0.0, angle=0.0, flip=False, mirror=False):
 		assert(self.has_component())
 		comp = self.get_component()
-		newinstances = []
-		for inst in comp.instances:
-			if inst.selected:
-				shape = self.library.component_transform(inst.shape, xfrom=xfrom, yfrom=yfrom, xto=xto, yto=yto, angle=angle, flip=flip, mirror=mirror)
-				newinstances.append(self.make_instance(shape, True))
-			else:
-				newinstances.append(inst)
-		comp.instances = newinstances
+		comp.instances = self.transform_instances(comp.instances, xfrom, yfrom, xto, yto, angle, flip, mirror)
 		if not self.drag_active and not self.handle_active:
 			self.complete_action()
 		self.update_params()
@@ -570,8 +707,10 @@ class LayoutViewer(QWidget):
 			self.update()
 	
 	def key_reload(self):
-		del self.library
-		self.load_library()
+		for (name, stats) in sorted(self.library.cache_stats().items()):
+			print("Cache '%s': %d hits, %d misses, %d entries." % ((name,) + stats))
+		# only files that changed are loaded again, and only instances that depend on them are updated
+		changed = self.library.reload(self.library_files(), self.load_processes())
 		instances = set()
 		for comp in self.components:
 			for i in range(len(comp.history_instances)):
@@ -579,8 +718,16 @@ class LayoutViewer(QWidget):
 					instances.add(inst)
 			for inst in comp.instances:
 				instances.add(inst)
+		count = 0
 		for inst in instances:
-			self.update_instance(inst)
+			if inst.shape["type"] in changed:
+				self.update_instance(inst)
+				count += 1
+		if count != 0:
+			for comp in self.components:
+				comp.index_clear()
+				comp.display_clear()
+		print("Reloaded %d components, updated %d instances." % (len(changed), count))
 		self.update_params()
 		self.update()
 	
@@ -635,7 +782,7 @@ class LayoutViewer(QWidget):
 				filename = filename[:-4]
 			pcb = alterpcb_core.Pcb()
 			for inst in comp.instances:
-				pcb.shapes += inst.flat
+				pcb.shapes += inst.geometry.to_shapes()
 			pcb.export(os.path.dirname(filename), os.path.basename(filename), self.main.layerviewer.layerstack)
 	
 	def key_export_image(self):
@@ -652,7 +799,7 @@ class LayoutViewer(QWidget):
 				filename += ".svg"
 			pcb = alterpcb_core.Pcb()
 			for inst in comp.instances:
-				pcb.shapes += inst.flat
+				pcb.shapes += inst.geometry.to_shapes()
 			pcb.export_svg(filename, self.main.layerviewer.layerstack)
 	
 	def key_antialias(self):
@@ -827,11 +974,19 @@ class LayoutViewer(QWidget):
 			return
 		comp = self.get_component()
 		self.cancel_actions()
+		shapes = [inst.shape for inst in comp.instances if inst.selected]
+		shapes = self.library.component_snap_many(shapes, self.effective_grid_step_x(), self.effective_grid_step_y(), comp.grid_origin_x, comp.grid_origin_y, comp.grid_angle)
 		newinstances = []
+		pos = 0
 		for inst in comp.instances:
 			if inst.selected:
-				shape = self.library.component_snap(inst.shape, self.effective_grid_step_x(), self.effective_grid_step_y(), comp.grid_origin_x, comp.grid_origin_y, comp.grid_angle)
-				newinstances.append(self.make_instance(shape, True))
+				shape = shapes[pos]
+				pos += 1
+				# only instances that actually moved need to be flattened again
+				if shape == inst.shape:
+					newinstances.append(self.make_instance(shape, True, inst))
+				else:
+					newinstances.append(self.make_instance(shape, True))
 			else:
 				newinstances.append(inst)
 		comp.instances = newinstances
@@ -1044,14 +1199,7 @@ class LayoutViewer(QWidget):
 			if self.select_active:
 				(self.select_x2, self.select_y2) = (mx, my)
 			if self.drag_active and (cx != self.cursor_x or cy != self.cursor_y):
-				newinstances = []
-				for inst in comp.instances:
-					if inst.selected:
-						shape = self.library.component_transform(inst.shape, self.cursor_x, self.cursor_y, cx, cy, 0.0, False, False)
-						newinstances.append(self.make_instance(shape, True))
-					else:
-						newinstances.append(inst)
-				comp.instances = newinstances
+				comp.instances = self.transform_instances(comp.instances, self.cursor_x, self.cursor_y, cx, cy, 0.0, False, False)
 				self.update_params()
 			if self.handle_active:
 				newinstances = []
@@ -1076,6 +1224,57 @@ class LayoutViewer(QWidget):
 		self.update()
 		event.accept()
 	
+	def build_paths(self, tables, boxes=None):
+		# Merges a list of (geometry, layer, type, group, rows) tables into a fill and a stroke path, rows is None for
+		# the whole group (see Component.get_display). Filled shapes are counterclockwise so the winding fill rule
+		# draws the union of overlapping shapes. The outlines are stroked by Qt, which has its own winding convention,
+		# so they are merged into the second path.
+		comp = self.get_component()
+		lod = self.lod_shape_size[self.quality] / comp.view_scale
+		fill = QPainterPath()
+		fill.setFillRule(Qt.WindingFill)
+		stroke = QPainterPath()
+		stroke.setFillRule(Qt.WindingFill)
+		if boxes is not None:
+			for box in boxes:
+				fill.addRect(box)
+		for (geometry, layer, typ, group, rows) in tables:
+			display = comp.get_display(geometry, layer, typ)
+			
+			# complete groups without small shapes are added at once
+			if rows is None:
+				if display["group_sizes"][group] >= lod:
+					(group_fill, group_stroke) = comp.get_display(geometry, layer, typ, True)["paths"][group]
+					fill.addPath(group_fill)
+					stroke.addPath(group_stroke)
+					continue
+				rows = display["groups"][group]
+			
+			# shapes that are only a few pixels wide are drawn as their bounding box
+			table = geometry.layers[layer][typ]
+			small = (display["size"][rows] < lod)
+			for i in rows[small]:
+				fill.addRect(QRectF(table["xmin"][i], table["ymin"][i], table["xmax"][i] - table["xmin"][i], table["ymax"][i] - table["ymin"][i]))
+			rows = rows[~small]
+			if len(rows) == 0:
+				continue
+			
+			# the other shapes come from the display lists of the component
+			items = comp.get_display(geometry, layer, typ, True)["items"]
+			for i in rows:
+				(outlined, path) = items[i]
+				(fill if not outlined else stroke).addPath(path)
+		return (fill, stroke)
+	
+	def draw_paths(self, painter, paths):
+		for path in paths:
+			if not path.isEmpty():
+				painter.drawPath(path)
+	
+	def draw_tables(self, painter, tables, boxes=None):
+		# draws the tables with at most two calls
+		self.draw_paths(painter, self.build_paths(tables, boxes))
+	
 	def paintEvent(self, event):
 		painter = QPainter(self)
 		if self.antialias:
@@ -1115,15 +1314,41 @@ class LayoutViewer(QWidget):
 		# get layer order
 		(layers_ordered, layers_suppressed) = self.get_layer_order()
 		
-		# collect shapes by layer
-		layer_shapes = {}
+		# Collect the visible shape tables by layer and drawing order. The instances come from the spatial index of the
+		# component, then the bounding boxes of the layers and shapes within each instance are checked. Tables that are
+		# completely visible use the groups of their display list, only the others are split by order here. The margin
+		# covers the pen.
+		margin = 2.0 / comp.view_scale
+		visible = (view_xmin - margin, view_xmax + margin, view_ymin - margin, view_ymax + margin)
+		layer_orders = {}
+		layer_boxes = {}
 		for layer in layers_ordered:
-			layer_shapes[layer["name"]] = []
-		for inst in comp.instances:
-			for shape in inst.flat:
-				ls = layer_shapes.get(shape["layer"])
-				if ls is not None:
-					ls.append(shape)
+			layer_orders[layer["name"]] = {}
+			layer_boxes[layer["name"]] = {}
+		lod = self.lod_text_size[self.quality] / comp.view_scale
+		for inst in comp.get_instances_bbox(*visible):
+			
+			# components such as text are drawn as one box per layer when they are small, in the first order they use
+			if min(inst.bbox[1] - inst.bbox[0], inst.bbox[3] - inst.bbox[2]) < lod and self.library.component_lod_box(inst.shape):
+				for (name, box) in inst.geometry.layer_bboxes.items():
+					boxes = layer_boxes.get(name)
+					if boxes is not None:
+						order = min(comp.get_display(inst.geometry, name, typ)["orders"][0] for typ in inst.geometry.layers[name])
+						boxes.setdefault(order, []).append(QRectF(box[0], box[2], box[1] - box[0], box[3] - box[2]))
+				continue
+			
+			for (name, typ, table, rows) in inst.geometry.tables_bbox(*visible):
+				buckets = layer_orders.get(name)
+				if buckets is None:
+					continue
+				display = comp.get_display(inst.geometry, name, typ)
+				if len(rows) == len(display["keys"]):
+					for order in display["orders"]:
+						buckets.setdefault(order, []).append((inst.geometry, name, typ, order, None))
+				else:
+					keys = display["keys"][rows]
+					for order in numpy.unique(keys).tolist():
+						buckets.setdefault(order, []).append((inst.geometry, name, typ, order, rows[keys == order]))
 		
 		# draw layers
 		for ll in range(len(layers_ordered)):
@@ -1158,15 +1383,9 @@ class LayoutViewer(QWidget):
 				layerpen   = QColor.fromRgbF(layer["color"][0]*0.5, layer["color"][1]*0.5, layer["color"][2]*0.5, 0.50)
 				layerbrush = QColor.fromRgbF(layer["color"][0]    , layer["color"][1]    , layer["color"][2]    , 0.25)
 			
-			# collect shapes by order
-			order_shapes = {}
-			for shape in layer_shapes[layer["name"]]:
-				order = shape["order"] * 2 + 1 if shape["hole"] else shape["order"] * 2
-				if order not in order_shapes:
-					order_shapes[order] = []
-				order_shapes[order].append(shape)
-			orders = list(order_shapes.keys())
-			orders.sort()
+			buckets = layer_orders[layer["name"]]
+			boxes = layer_boxes[layer["name"]]
+			orders = sorted(set(buckets) | set(boxes))
 			
 			if self.quality == self.quality_high:
 				
@@ -1183,15 +1402,7 @@ class LayoutViewer(QWidget):
 				imgpainter.setBrush(QColor(0, 0, 0, 255)) # layer["color"][0], layer["color"][1], layer["color"][2]
 				for order in orders:
 					imgpainter.setCompositionMode(QPainter.CompositionMode_SourceOver if order % 2 == 0 else QPainter.CompositionMode_DestinationOut)
-					for shape in order_shapes[order]:
-						(px, py) = alterpcb_core.shape_to_polygon(shape)
-						if shape["outline"] == 0.0:
-							imgpainter.drawPolygon([QPointF(px[i], py[i]) for i in range(len(px))])
-						else:
-							first = 1 if shape["type"] == "polygon" and not shape["closed"] else 0
-							for i in range(first, len(px)):
-								(px2, py2) = alterpcb_core.stroke_line(px[i - 1], py[i - 1], px[i], py[i], shape["outline"])
-								imgpainter.drawPolygon([QPointF(px2[i], py2[i]) for i in range(len(px2))])
+					self.draw_tables(imgpainter, buckets.get(order, []), boxes.get(order))
 				imgpainter.resetTransform()
 				imgpainter.setCompositionMode(QPainter.CompositionMode_SourceIn)
 				imgpainter.fillRect(0, 0, self.width(), self.height(), layerbrush)
@@ -1206,31 +1417,19 @@ class LayoutViewer(QWidget):
 			for order in orders:
 				painter.setPen(layerpen)
 				painter.setBrush(layerbrush if order % 2 == 0 and self.quality != self.quality_high else Qt.NoBrush)
-				for shape in order_shapes[order]:
-					(px, py) = alterpcb_core.shape_to_polygon(shape)
-					if shape["outline"] == 0.0:
-						painter.drawPolygon([QPointF(px[i], py[i]) for i in range(len(px))])
-					else:
-						first = 1 if shape["type"] == "polygon" and not shape["closed"] else 0
-						for i in range(first, len(px)):
-							(px2, py2) = alterpcb_core.stroke_line(px[i - 1], py[i - 1], px[i], py[i], shape["outline"])
-							painter.drawPolygon([QPointF(px2[i], py2[i]) for i in range(len(px2))])
+				self.draw_tables(painter, buckets.get(order, []), boxes.get(order))
 		
 		# draw selection
+		selected = []
+		for inst in comp.get_instances_bbox(*visible):
+			if inst.selected:
+				for (name, typ, table, rows) in inst.geometry.tables_bbox(*visible):
+					selected.append((inst.geometry, name, typ, None, rows if len(rows) != len(table["index"]) else None))
+		paths = self.build_paths(selected)
 		for pen in (False, True):
 			painter.setPen(self.color_selectionpen if pen else Qt.NoPen)
 			painter.setBrush(Qt.NoBrush if pen else self.color_selectionbrush)
-			for inst in comp.instances:
-				if inst.selected:
-					for shape in inst.flat:
-						(px, py) = alterpcb_core.shape_to_polygon(shape)
-						if shape["outline"] == 0.0:
-							painter.drawPolygon([QPointF(px[i], py[i]) for i in range(len(px))])
-						else:
-							first = 1 if shape["type"] == "polygon" and not shape["closed"] else 0
-							for i in range(first, len(px)):
-								(px2, py2) = alterpcb_core.stroke_line(px[i - 1], py[i - 1], px[i], py[i], shape["outline"])
-								painter.drawPolygon([QPointF(px2[i], py2[i]) for i in range(len(px2))])
+			self.draw_paths(painter, paths)
 		
 		# draw handles
 		painter.setPen(self.color_handlepen)
@@ -41,6 +41,56 @@ def transform_path(shape, xfrom, yfrom, xto, yto, angle, flip, mirror):
 		shape["layer"] = alterpcb_core.flip_layer(shape["layer"])
 	return shape
 
+def transform_many_line(shapes, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	(px1, py1) = alterpcb_core.transform_many_points(shapes, "x1", "y1", xfrom, yfrom, xto, yto, angle, flip, mirror)
+	(px2, py2) = alterpcb_core.transform_many_points(shapes, "x2", "y2", xfrom, yfrom, xto, yto, angle, flip, mirror)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x1"], shape["y1"], shape["x2"], shape["y2"]) = (px1[i], py1[i], px2[i], py2[i])
+		if flip:
+			shape["layer"] = alterpcb_core.flip_layer(shape["layer"])
+		result.append(shape)
+	return result
+
+def transform_many_arc(shapes, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	(px, py) = alterpcb_core.transform_many_points(shapes, "x", "y", xfrom, yfrom, xto, yto, angle, flip, mirror)
+	angle1 = alterpcb_core.shape_column(shapes, "angle1")
+	angle2 = alterpcb_core.shape_column(shapes, "angle2")
+	d = angle2 - angle1
+	if flip != mirror:
+		angle1 = (angle - angle1 + 180.0) % 360.0
+		angle2 = angle1 - d
+	else:
+		angle1 = (angle + angle1) % 360.0
+		angle2 = angle1 + d
+	(angle1, angle2) = (angle1.tolist(), angle2.tolist())
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"], shape["angle1"], shape["angle2"]) = (px[i], py[i], angle1[i], angle2[i])
+		if flip:
+			shape["layer"] = alterpcb_core.flip_layer(shape["layer"])
+		result.append(shape)
+	return result
+
+def transform_many_path(shapes, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	vertices = alterpcb_core.transform_many_vertices(shapes, "x", "y", xfrom, yfrom, xto, yto, angle, flip, mirror)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"]) = vertices[i]
+		if flip != mirror:
+			if type(shape["width"]) == list:
+				shape["width"] = shape["width"][::-1]
+			if type(shape["space"]) == list:
+				shape["space"] = shape["space"][::-1]
+			shape["centerline"] = -shape["centerline"]
+		if flip:
+			shape["layer"] = alterpcb_core.flip_layer(shape["layer"])
+		result.append(shape)
+	return result
+
 def snap_line(shape, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
 	shape = shape.copy()
 	(shape["x1"], shape["y1"]) = alterpcb_core.snap_point(shape["x1"], shape["y1"], grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
@@ -60,6 +110,35 @@ def snap_path(shape, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, gri
 	(shape["x"], shape["y"]) = (list(px), list(py))
 	return shape
 
+def snap_many_line(shapes, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+	(px1, py1) = alterpcb_core.snap_many_points(shapes, "x1", "y1", grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	(px2, py2) = alterpcb_core.snap_many_points(shapes, "x2", "y2", grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x1"], shape["y1"], shape["x2"], shape["y2"]) = (px1[i], py1[i], px2[i], py2[i])
+		result.append(shape)
+	return result
+
+def snap_many_arc(shapes, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+	(px, py) = alterpcb_core.snap_many_points(shapes, "x", "y", grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	pr = alterpcb_core.snap_many_values(shapes, "radius", grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"], shape["radius"]) = (px[i], py[i], pr[i])
+		result.append(shape)
+	return result
+
+def snap_many_path(shapes, grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle):
+	vertices = alterpcb_core.snap_many_vertices(shapes, "x", "y", grid_step_x, grid_step_y, grid_origin_x, grid_origin_y, grid_angle)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"]) = vertices[i]
+		result.append(shape)
+	return result
+
 def handles_line(shape):
 	return [
 		{"x": shape["x1"], "y": shape["y1"]},
@@ -87,96 +166,101 @@ def handlemove_path(shape, index, x, y):
 	shape["y"][index] = y
 	return shape
 
-def decasteljau(x, py):
-	x = numpy.array(x)
-	d = numpy.array(py)[:,None]
-	while len(d) > 1:
-		d = d[:-1] + (d[1:] - d[:-1]) * x[None,:]
-	return d[0]
+# Bernstein basis matrices for uniformly spaced parameters, for each (degree, steps)
+bernstein_tables = {}
+
+def bernstein(degree, t):
+	# Bernstein basis polynomials of the given degree, one row for each value of t
+	coef = numpy.ones(degree + 1)
+	for k in range(1, degree + 1):
+		coef[k] = coef[k - 1] * (degree - k + 1) / k
+	k = numpy.arange(degree + 1)
+	return coef[None, :] * t[:, None] ** k[None, :] * (1.0 - t[:, None]) ** (degree - k)[None, :]
+
+def bernstein_uniform(degree, steps):
+	key = (degree, steps)
+	if key not in bernstein_tables:
+		bernstein_tables[key] = bernstein(degree, numpy.arange(steps + 1) / steps)
+	return bernstein_tables[key]
+
+def elevate(control, degree):
+	# raises the degree of a Bezier curve without changing its shape
+	control = numpy.array(control, dtype=numpy.float64)
+	while len(control) < degree + 1:
+		a = numpy.arange(1, len(control)) / len(control)
+		control = numpy.concatenate((control[:1], a * control[:-1] + (1.0 - a) * control[1:], control[-1:]))
+	return control
+
+def adaptive_parameters(control, tolerance, steps):
+	# Splits segments in half until the middle of each segment is within the tolerance of the chord, using at most
+	# 'steps' segments. Starts with one segment per degree, so S-shaped curves aren't mistaken for straight lines.
+	degree = len(control) - 1
+	t = numpy.linspace(0.0, 1.0, max(1, min(degree, steps)) + 1)
+	points = bernstein(degree, t).dot(control)
+	while len(t) - 1 < steps:
+		middle = (t[:-1] + t[1:]) / 2
+		middle_points = bernstein(degree, middle).dot(control)
+		error = numpy.hypot(*(middle_points - (points[:-1] + points[1:]) / 2).T)
+		split = numpy.flatnonzero(error > tolerance)
+		if len(split) == 0:
+			break
+		# split the worst segments first if there are too many
+		split = numpy.sort(split[numpy.argsort(-error[split], kind="stable")[:steps - (len(t) - 1)]])
+		t = numpy.insert(t, split + 1, middle[split])
+		points = numpy.insert(points, split + 1, middle_points[split], axis=0)
+	return t
 
 def normalize(vx, vy):
 	d = numpy.hypot(vx, vy)
 	with numpy.errstate(divide='ignore', invalid='ignore'):
 		return (numpy.nan_to_num(vx / d), numpy.nan_to_num(vy / d))
 
-def shift_path1(pathx, pathy, tx1, ty1, tx2, ty2, shift):
+def shift_paths(pathx, pathy, tx1, ty1, tx2, ty2, shift, envelope):
+	# Shifts the path by every row of 'shift' in turn and returns all intermediate paths as (stages, samples) arrays.
+	# Stages with 'envelope' set follow the envelope of circles with a varying radius (the edge of a tapered stroke),
+	# the others move along the miter normals. Each stage is rotated by the slope of the stages before it, which makes
+	# them additive, so they can be accumulated with a single cumsum instead of shifting the path stage by stage.
 	assert(len(pathx) == len(pathy))
 	assert(len(pathx) >= 2)
-	qx = numpy.zeros(len(pathx))
-	qy = numpy.zeros(len(pathx))
-	
-	# begin cap
-	qx[0] = pathx[0] - ty1 * shift[0]
-	qy[0] = pathy[0] + tx1 * shift[0]
-	
-	# end cap
-	qx[-1] = pathx[-1] - ty2 * shift[-1]
-	qy[-1] = pathy[-1] + tx2 * shift[-1]
+	ds = numpy.hypot(pathx[1:] - pathx[:-1], pathy[1:] - pathy[:-1])
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		phi = numpy.arctan(numpy.nan_to_num(numpy.diff(numpy.cumsum(shift, axis=0) - shift, axis=1) / ds))
+		alpha = numpy.arcsin(numpy.clip(numpy.nan_to_num(numpy.diff(shift, axis=1) / ds), -1.0, 1.0))
+	beta = numpy.arctan2(pathy[1:] - pathy[:-1], pathx[1:] - pathx[:-1])
+	gamma = (beta[1:] - beta[:-1]) - numpy.round((beta[1:] - beta[:-1]) / (2 * math.pi)) * (2 * math.pi)
 	
 	# middle part
-	(vx1, vy1) = normalize(pathx[1:-1] - pathx[:-2], pathy[1:-1] - pathy[:-2])
-	(vx2, vy2) = normalize(pathx[2:] - pathx[1:-1], pathy[2:] - pathy[1:-1])
-	d = numpy.maximum(0.2, 1.0 + vx1 * vx2 + vy1 * vy2)
-	nx = (vy1 + vy2) / d
-	ny = -(vx1 + vx2) / d
-	qx[1:-1] = pathx[1:-1] - nx * shift[1:-1]
-	qy[1:-1] = pathy[1:-1] - ny * shift[1:-1]
-	
-	return (qx, qy)
-
-def shift_path2(pathx, pathy, tx1, ty1, tx2, ty2, shift):
-	assert(len(pathx) == len(pathy))
-	assert(len(pathx) >= 2)
-	qx = numpy.zeros(len(pathx))
-	qy = numpy.zeros(len(pathx))
+	envelope = numpy.asarray(envelope)[:, None]
+	c = numpy.cos((gamma + phi[:, 1:] - phi[:, :-1]) / 2)
+	r = numpy.where(envelope, shift[:, 1:-1] / numpy.maximum(0.1, numpy.cos((alpha[:, :-1] - alpha[:, 1:]) / 2)), shift[:, 1:-1] * 2 * c / numpy.maximum(0.2, 2 * c * c))
+	angle = beta[:-1] + (gamma + phi[:, :-1] + phi[:, 1:]) / 2 + numpy.where(envelope, (alpha[:, :-1] + alpha[:, 1:]) / 2, 0.0)
+	dx = numpy.zeros(shift.shape)
+	dy = numpy.zeros(shift.shape)
+	dx[:, 1:-1] = -numpy.sin(angle) * r
+	dy[:, 1:-1] = numpy.cos(angle) * r
 	
 	# begin cap
-	qx[0] = pathx[0] - ty1 * shift[0]
-	qy[0] = pathy[0] + tx1 * shift[0]
+	dx[:, 0] = -ty1 * shift[:, 0]
+	dy[:, 0] = tx1 * shift[:, 0]
 	
 	# end cap
-	qx[-1] = pathx[-1] - ty2 * shift[-1]
-	qy[-1] = pathy[-1] + tx2 * shift[-1]
-	
-	# middle part
-	#(vx1, vy1) = normalize(qx[1:-1] - qx[:-2], qy[1:-1] - qy[:-2])
-	#(vx2, vy2) = normalize(qx[2:] - qx[1:-1], qy[2:] - qy[1:-1])
-	#d = numpy.maximum(0.2, 1.0 + vx1 * vx2 + vy1 * vy2)
-	#nx = (vy1 + vy2) / d
-	#ny = -(vx1 + vx2) / d
-	#qx[1:-1] = pathx[1:-1] + nx * shift[1:-1]
-	#qy[1:-1] = pathy[1:-1] + ny * shift[1:-1]
-	alpha = numpy.arcsin(numpy.clip((shift[1:] - shift[:-1]) / numpy.hypot(pathx[1:] - pathx[:-1], pathy[1:] - pathy[:-1]), -1.0, 1.0))
-	beta = numpy.arctan2(pathy[1:] - pathy[:-1], pathx[1:] - pathx[:-1])
-	gamma = (beta[1:] - beta[:-1]) - numpy.round((beta[1:] - beta[:-1]) / (2 * math.pi)) * (2 * math.pi)
-	r = shift[1:-1] / numpy.maximum(0.1, numpy.cos((alpha[:-1] - alpha[1:]) / 2))
-	qx[1:-1] = pathx[1:-1] - numpy.sin(beta[:-1] + (gamma + alpha[:-1] + alpha[1:]) / 2) * r
-	qy[1:-1] = pathy[1:-1] + numpy.cos(beta[:-1] + (gamma + alpha[:-1] + alpha[1:]) / 2) * r
-	#px4 = pathx[1:-1] + numpy.sin(beta[:-1] + (gamma - alpha[:-1] - alpha[1:]) / 2) * r
-	#py4 = pathy[1:-1] - numpy.cos(beta[:-1] + (gamma - alpha[:-1] - alpha[1:]) / 2) * r
+	dx[:, -1] = -ty2 * shift[:, -1]
+	dy[:, -1] = tx2 * shift[:, -1]
 	
-	return (qx, qy)
+	return (pathx + numpy.cumsum(dx, axis=0), pathy + numpy.cumsum(dy, axis=0))
 
 def stroke_path(pathx, pathy, tx1, ty1, tx2, ty2, width, shift, steps=18):
-	assert(len(pathx) == len(pathy))
-	assert(len(pathx) >= 2)
+	# the samples are along the last axis, leading axes are tracks
+	assert(pathx.shape == pathy.shape)
+	assert(pathx.shape[-1] >= 2)
 	
 	#(pathx, pathy) = shift_path(pathx, pathy, tx1, ty1, tx2, ty2, shift)
-	(ptx1, pty1) = normalize(pathx[ 1] - pathx[ 0], pathy[ 1] - pathy[ 0])
-	(ptx2, pty2) = normalize(pathx[-1] - pathx[-2], pathy[-1] - pathy[-2])
-	
-	px1 = numpy.zeros(steps + 1)
-	py1 = numpy.zeros(steps + 1)
-	px2 = numpy.zeros(len(pathx) - 2)
-	py2 = numpy.zeros(len(pathx) - 2)
-	px3 = numpy.zeros(steps + 1)
-	py3 = numpy.zeros(steps + 1)
-	px4 = numpy.zeros(len(pathx) - 2)
-	py4 = numpy.zeros(len(pathx) - 2)
+	(ptx1, pty1) = normalize(pathx[..., 1:2] - pathx[..., 0:1], pathy[..., 1:2] - pathy[..., 0:1])
+	(ptx2, pty2) = normalize(pathx[..., -1:] - pathx[..., -2:-1], pathy[..., -1:] - pathy[..., -2:-1])
 	
-	alpha = numpy.arcsin(numpy.clip((width[1:] - width[:-1]) / (2 * numpy.hypot(pathx[1:] - pathx[:-1], pathy[1:] - pathy[:-1])), -1.0, 1.0))
-	beta = numpy.arctan2(pathy[1:] - pathy[:-1], pathx[1:] - pathx[:-1])
-	gamma = (beta[1:] - beta[:-1]) - numpy.round((beta[1:] - beta[:-1]) / (2 * math.pi)) * (2 * math.pi)
+	alpha = numpy.arcsin(numpy.clip((width[..., 1:] - width[..., :-1]) / (2 * numpy.hypot(pathx[..., 1:] - pathx[..., :-1], pathy[..., 1:] - pathy[..., :-1])), -1.0, 1.0))
+	beta = numpy.arctan2(pathy[..., 1:] - pathy[..., :-1], pathx[..., 1:] - pathx[..., :-1])
+	gamma = (beta[..., 1:] - beta[..., :-1]) - numpy.round((beta[..., 1:] - beta[..., :-1]) / (2 * math.pi)) * (2 * math.pi)
 	
 	#print("width = " + str(width))
 	#print("alpha = " + str(alpha))
@@ -184,21 +268,21 @@ def stroke_path(pathx, pathy, tx1, ty1, tx2, ty2, width, shift, steps=18):
 	#print("gamma = " + str(gamma))
 	
 	# begin cap
-	t = (numpy.arange(steps + 1) / (steps) - 0.5) * (math.pi - 2 * alpha[0])
-	px1 = pathx[0] - ptx1 * width[0] / 2 * numpy.cos(t) - pty1 * width[0] / 2 * numpy.sin(t)
-	py1 = pathy[0] - pty1 * width[0] / 2 * numpy.cos(t) + ptx1 * width[0] / 2 * numpy.sin(t)
+	t = (numpy.arange(steps + 1) / (steps) - 0.5) * (math.pi - 2 * alpha[..., 0:1])
+	px1 = pathx[..., 0:1] - ptx1 * width[..., 0:1] / 2 * numpy.cos(t) - pty1 * width[..., 0:1] / 2 * numpy.sin(t)
+	py1 = pathy[..., 0:1] - pty1 * width[..., 0:1] / 2 * numpy.cos(t) + ptx1 * width[..., 0:1] / 2 * numpy.sin(t)
 	
 	# end cap
-	t = (numpy.arange(steps + 1) / (steps) - 0.5) * (math.pi + 2 * alpha[-1])
-	px3 = pathx[-1] + ptx2 * width[-1] / 2 * numpy.cos(t) + pty2 * width[-1] / 2 * numpy.sin(t)
-	py3 = pathy[-1] + pty2 * width[-1] / 2 * numpy.cos(t) - ptx2 * width[-1] / 2 * numpy.sin(t)
+	t = (numpy.arange(steps + 1) / (steps) - 0.5) * (math.pi + 2 * alpha[..., -1:])
+	px3 = pathx[..., -1:] + ptx2 * width[..., -1:] / 2 * numpy.cos(t) + pty2 * width[..., -1:] / 2 * numpy.sin(t)
+	py3 = pathy[..., -1:] + pty2 * width[..., -1:] / 2 * numpy.cos(t) - ptx2 * width[..., -1:] / 2 * numpy.sin(t)
 	
 	# middle part
-	r = width[1:-1] / (2 * numpy.maximum(0.1, numpy.cos((alpha[:-1] - alpha[1:]) / 2)))
-	px2 = pathx[1:-1] - numpy.sin(beta[:-1] + (gamma + alpha[:-1] + alpha[1:]) / 2) * r
-	py2 = pathy[1:-1] + numpy.cos(beta[:-1] + (gamma + alpha[:-1] + alpha[1:]) / 2) * r
-	px4 = pathx[1:-1] + numpy.sin(beta[:-1] + (gamma - alpha[:-1] - alpha[1:]) / 2) * r
-	py4 = pathy[1:-1] - numpy.cos(beta[:-1] + (gamma - alpha[:-1] - alpha[1:]) / 2) * r
+	r = width[..., 1:-1] / (2 * numpy.maximum(0.1, numpy.cos((alpha[..., :-1] - alpha[..., 1:]) / 2)))
+	px2 = pathx[..., 1:-1] - numpy.sin(beta[..., :-1] + (gamma + alpha[..., :-1] + alpha[..., 1:]) / 2) * r
+	py2 = pathy[..., 1:-1] + numpy.cos(beta[..., :-1] + (gamma + alpha[..., :-1] + alpha[..., 1:]) / 2) * r
+	px4 = pathx[..., 1:-1] + numpy.sin(beta[..., :-1] + (gamma - alpha[..., :-1] - alpha[..., 1:]) / 2) * r
+	py4 = pathy[..., 1:-1] - numpy.cos(beta[..., :-1] + (gamma - alpha[..., :-1] - alpha[..., 1:]) / 2) * r
 	
 	#(vx1, vy1) = normalize(pathx[1:-1] - pathx[ :-2], pathy[1:-1] - pathy[ :-2])
 	#(vx2, vy2) = normalize(pathx[2:  ] - pathx[1:-1], pathy[2:  ] - pathy[1:-1])
@@ -212,7 +296,7 @@ def stroke_path(pathx, pathy, tx1, ty1, tx2, ty2, width, shift, steps=18):
 	#px4 = pathx[1:-1] + nx * width[1:-1] / 2
 	#py4 = pathy[1:-1] + ny * width[1:-1] / 2
 	
-	return (numpy.concatenate((px1, px2, px3, px4[::-1])), numpy.concatenate((py1, py2, py3, py4[::-1])))
+	return (numpy.concatenate((px1, px2, px3, px4[..., ::-1]), axis=-1), numpy.concatenate((py1, py2, py3, py4[..., ::-1]), axis=-1))
 
 def array_extend(arr, n):
 	#if type(arr) != list:
@@ -228,16 +312,17 @@ def maybe_list(x, i):
 	else:
 		return x
 
-@component(transform=transform_line, snap=snap_line, handles=handles_line, handlemove=handlemove_line)
+@component(transform=transform_line, snap=snap_line, handles=handles_line, handlemove=handlemove_line, transform_many=transform_many_line, snap_many=snap_many_line)
 def line(layer="copper1-top", x1=0.0, y1=0.0, x2=1.0, y2=1.0, width=1.0, hole=False, order=0):
 	pcb = alterpcb_core.Pcb()
 	pcb.add("polygon", layer=layer, x=[x1, x2], y=[y1, y2], closed=False, outline=width, hole=hole, order=order)
 	return pcb
 
-@component(transform=transform_arc, snap=snap_arc)
+@component(transform=transform_arc, snap=snap_arc, transform_many=transform_many_arc, snap_many=snap_many_arc)
 def arc(layer="copper1-top", x=0.0, y=0.0, radius=4.0, angle1=0.0, angle2=90.0, width=1.0, hole=False, order=0):
 	pcb = alterpcb_core.Pcb()
-	steps = max(2, 1 + int(round(abs(angle1 - angle2) / alterpcb_core.circle_step)))
+	# the outer edge of the stroke has the largest chord error
+	steps = 1 + alterpcb_core.arc_steps(abs(radius) + abs(width) / 2, angle2 - angle1, alterpcb_core.export_tolerance)
 	angle = numpy.linspace(angle1 * math.pi / 180, angle2 * math.pi / 180, steps)
 	pcb.add("polygon", layer=layer, x=list(x+radius*numpy.cos(angle)), y=list(y+radius*numpy.sin(angle)), closed=False, outline=width, hole=hole, order=order)
 	return pcb
@@ -273,83 +358,59 @@ def oval(layer="copper1-top", x=0.0, y=0.0, width=2.0, height=1.0, angle=0.0, ou
 		pcb.add("circle", layer=layer, x=x, y=y, radius=width/2, outline=outline, hole=hole, order=order, pad=pad)
 	return pcb
 
-@component(transform=transform_path, snap=snap_path, handles=handles_path, handlemove=handlemove_path)
-def path(layer="copper1-top", x=[0.0, 0.0, 1.0, 1.0], y=[0.0, 1.0, 2.0, 3.0], width=[1.0], space=[], steps=16, centerline=0, hole=False, order=0):
+@component(transform=transform_path, snap=snap_path, handles=handles_path, handlemove=handlemove_path, transform_many=transform_many_path, snap_many=snap_many_path)
+def path(layer="copper1-top", x=[0.0, 0.0, 1.0, 1.0], y=[0.0, 1.0, 2.0, 3.0], width=[1.0], space=[], steps=16, tolerance=0.0, centerline=0, hole=False, order=0):
 	pcb = alterpcb_core.Pcb()
 	(px, py) = alterpcb_core.equalize_arrays(x, y)
 	if len(px) < 2:
 		return pcb
-	t = numpy.arange(steps + 1) / steps
-	pathx = decasteljau(t, px)
-	pathy = decasteljau(t, py)
 	(tx1, ty1) = normalize(px[ 1] - px[ 0], py[ 1] - py[ 0])
 	(tx2, ty2) = normalize(px[-1] - px[-2], py[-1] - py[-2])
 	tracks = min(len(width), len(space) + 1)
 	if tracks < 1:
 		return pcb
-	path_width = [decasteljau(t, w) if type(w) == list else numpy.repeat(w, steps + 1) for w in width]
-	path_space = [decasteljau(t, s) if type(s) == list else numpy.repeat(s, steps + 1) for s in space]
 	
-	#span = numpy.zeros(steps + 1)
-	#for track in range(tracks):
-		#span += path_width[track]
-		#if track != tracks - 1:
-			#span += path_space[track]
-	#path_shift = -span / 2
-	#for track in range(tracks):
-		#path_shift += path_width[track] / 2
-		#(qx, qy) = shift_path(pathx, pathy, tx1, ty1, tx2, ty2, path_shift)
-		#for i in range(len(qx)):
-			#pcb.add("circle", layer=layer, x=qx[i], y=qy[i], radius=path_width[track][i]/2, hole=hole, order=order)
-		##(qx, qy) = stroke_path(pathx, pathy, tx1, ty1, tx2, ty2, path_width[track], path_shift)
-		##pcb.add("polygon", layer=layer, x=list(qx), y=list(qy), closed=True, hole=hole, order=order)
-		#path_shift += path_width[track] / 2
-		#if track != tracks - 1:
-			#path_shift += path_space[track]
-	
-	#(qx, qy) = shift_path(pathx, pathy, tx1, ty1, tx2, ty2, path_shift)
+	# The path and all width/space profiles are raised to the same degree, so they can be evaluated with a single
+	# matrix product. With a tolerance, 'steps' is the maximum number of segments.
+	profiles = [(p if type(p) == list else [p]) for p in width + space]
+	degree = max([len(px) - 1] + [len(p) - 1 for p in profiles])
+	control = numpy.column_stack([elevate(px, degree), elevate(py, degree)] + [elevate(p, degree) for p in profiles])
+	if tolerance > 0.0:
+		basis = bernstein(degree, adaptive_parameters(control[:, :2], tolerance, steps))
+	else:
+		basis = bernstein_uniform(degree, steps)
+	values = basis.dot(control)
+	steps = len(values) - 1
+	(pathx, pathy) = (values[:, 0], values[:, 1])
+	path_width = values[:, 2 : 2 + tracks].T
+	path_space = values[:, 2 + len(width) : 1 + len(width) + tracks].T
 	
-	# center line
+	# Boundary 4k is the first edge of track k, 4k+1 its center, 4k+2 its second edge and 4k+3 the center of the
+	# following space. Both sides of the center line are shifted one boundary per stage, all tracks at once.
 	ci = max(0, min(tracks * 4 - 2, centerline + tracks * 2 - 1))
+	centers = numpy.zeros((2, tracks, steps + 1))
 	if ci % 4 == 1:
-		(rx, ry) = stroke_path(pathx, pathy, tx1, ty1, tx2, ty2, path_width[ci // 4], numpy.zeros(steps + 1))
-		pcb.add("polygon", layer=layer, x=list(rx), y=list(ry), closed=True, hole=hole, order=order)
+		centers[:, ci // 4] = (pathx, pathy)
 	
 	# positive side
-	(qx, qy) = (pathx, pathy)
-	for ii in range(ci, tracks * 4 - 3):
-		if ii % 4 == 0:
-			(qx, qy) = shift_path1(qx, qy, tx1, ty1, tx2, ty2, path_width[ii // 4] / 2)
-			(rx, ry) = stroke_path(qx, qy, tx1, ty1, tx2, ty2, path_width[ii // 4], numpy.zeros(steps + 1))
-			pcb.add("polygon", layer=layer, x=list(rx), y=list(ry), closed=True, hole=hole, order=order)
-		elif ii % 4 == 1:
-			(qx, qy) = shift_path2(qx, qy, tx1, ty1, tx2, ty2, path_width[ii // 4] / 2)
-		elif ii % 4 == 2:
-			(qx, qy) = shift_path1(qx, qy, tx1, ty1, tx2, ty2, path_space[ii // 4] / 2)
-		else:
-			(qx, qy) = shift_path2(qx, qy, tx1, ty1, tx2, ty2, path_space[ii // 4] / 2)
+	rows = list(range(ci, tracks * 4 - 3))
+	if len(rows) != 0:
+		shift = numpy.array([(path_width if ii % 4 < 2 else path_space)[ii // 4] / 2 for ii in rows])
+		(qx, qy) = shift_paths(pathx, pathy, tx1, ty1, tx2, ty2, shift, [ii % 2 == 1 for ii in rows])
+		select = [j for j in range(len(rows)) if rows[j] % 4 == 0]
+		centers[:, [rows[j] // 4 for j in select]] = (qx[select], qy[select])
 	
-	# negative size
-	(qx, qy) = (pathx, pathy)
-	for ii in range(ci, 1, -1):
-		if ii % 4 == 0:
-			(qx, qy) = shift_path1(qx, qy, tx1, ty1, tx2, ty2, -path_space[ii // 4 - 1] / 2)
-		elif ii % 4 == 1:
-			(qx, qy) = shift_path2(qx, qy, tx1, ty1, tx2, ty2, -path_width[ii // 4] / 2)
-		elif ii % 4 == 2:
-			(qx, qy) = shift_path1(qx, qy, tx1, ty1, tx2, ty2, -path_width[ii // 4] / 2)
-			(rx, ry) = stroke_path(qx, qy, tx1, ty1, tx2, ty2, path_width[ii // 4], numpy.zeros(steps + 1))
-			pcb.add("polygon", layer=layer, x=list(rx), y=list(ry), closed=True, hole=hole, order=order)
-		else:
-			(qx, qy) = shift_path2(qx, qy, tx1, ty1, tx2, ty2, -path_space[ii // 4] / 2)
+	# negative side
+	rows = list(range(ci, 1, -1))
+	if len(rows) != 0:
+		shift = numpy.array([-(path_width if (ii - 1) % 4 < 2 else path_space)[(ii - 1) // 4] / 2 for ii in rows])
+		(qx, qy) = shift_paths(pathx, pathy, tx1, ty1, tx2, ty2, shift, [ii % 2 == 1 for ii in rows])
+		select = [j for j in range(len(rows)) if rows[j] % 4 == 2]
+		centers[:, [rows[j] // 4 for j in select]] = (qx[select], qy[select])
 	
-	#for track in range(tracks):
-		##pcb.add("polygon", layer=layer, x=list(qx), y=list(qy), closed=False, outline=0.01, hole=hole, order=order)
-		#(qx, qy) = shift_path1(qx, qy, tx1, ty1, tx2, ty2, path_width[track] / 2)
-		#(rx, ry) = stroke_path(qx, qy, tx1, ty1, tx2, ty2, path_width[track], numpy.zeros(steps + 1))
-		#pcb.add("polygon", layer=layer, x=list(rx), y=list(ry), closed=True, hole=hole, order=order)
-		#(qx, qy) = shift_path2(qx, qy, tx1, ty1, tx2, ty2, path_width[track] / 2)
-		#if track != tracks - 1:
-			#(qx, qy) = shift_path1(qx, qy, tx1, ty1, tx2, ty2, path_space[track] / 2)
-			#(qx, qy) = shift_path2(qx, qy, tx1, ty1, tx2, ty2, path_space[track] / 2)
+	# center track first, then the positive side, then the negative side
+	(rx, ry) = stroke_path(centers[0], centers[1], tx1, ty1, tx2, ty2, path_width, None)
+	sequence = [t for t in range(tracks) if t * 4 + 1 == ci] + [t for t in range(tracks) if t * 4 >= ci] + [t for t in reversed(range(tracks)) if t * 4 + 2 <= ci]
+	for t in sequence:
+		pcb.add("polygon", layer=layer, x=list(rx[t]), y=list(ry[t]), closed=True, hole=hole, order=order)
 	return pcb
@@ -16,6 +16,20 @@ def transform_text(shape, xfrom, yfrom, xto, yto, angle, flip, mirror):
 		shape["layer"] = alterpcb_core.flip_layer(shape["layer"])
 	return shape
 
+def transform_many_text(shapes, xfrom, yfrom, xto, yto, angle, flip, mirror):
+	(px, py) = alterpcb_core.transform_many_points(shapes, "x", "y", xfrom, yfrom, xto, yto, angle, flip, mirror)
+	pa = alterpcb_core.transform_many_angles(shapes, "angle", angle, flip, mirror)
+	result = []
+	for i in range(len(shapes)):
+		shape = shapes[i].copy()
+		(shape["x"], shape["y"], shape["angle"]) = (px[i], py[i], pa[i])
+		if flip != mirror:
+			shape["mirror"] = not shape["mirror"]
+		if flip:
+			shape["layer"] = alterpcb_core.flip_layer(shape["layer"])
+		result.append(shape)
+	return result
+
 def bezier1(a, b, t):
 	s = 1.0 - t
 	return s * a + t * b
@@ -36,7 +50,64 @@ def polygon_direction(x, y):
 
 loaded_fonts = {}
 
-@component(transform=transform_text)
+# Glyphs are tessellated once and stored in font units as (advance, contours), each contour is (x, y, ccw). The number
+# of segments per curve depends on the scale, so the size is part of the key.
+glyph_cache = {}
+kerning_cache = {}
+
+def load_glyph(font, char, size, steps):
+	key = (font, char, size, steps)
+	if key not in glyph_cache:
+		face = loaded_fonts[font]
+		scale = size / face.units_per_EM
+		face.load_char(char, freetype.FT_LOAD_NO_HINTING | freetype.FT_LOAD_NO_SCALE)
+		outline = face.glyph.outline
+		points = numpy.array(outline.points, dtype=float).reshape(-1, 2)
+		tags = numpy.array(outline.tags, dtype=int)
+		contours = []
+		start = 0
+		for contour in outline.contours:
+			end = contour + 1
+			cp = points[start:end]
+			oncurve = ((tags[start:end] >> 0) & 1) != 0
+			assert(not numpy.any(((tags[start:end] >> 1) & 1)[~oncurve]))
+			start = end
+			
+			# control points halfway between two off-curve points are implied
+			n = len(cp)
+			prev = numpy.roll(numpy.arange(n), 1)
+			nxt = numpy.roll(numpy.arange(n), -1)
+			p1 = numpy.where(oncurve[prev, None], cp[prev], (cp + cp[prev]) / 2)
+			p2 = numpy.where(oncurve[nxt, None], cp[nxt], (cp + cp[nxt]) / 2)
+			
+			# the distance between a quadratic curve and its chords is at most |P0 - 2 P1 + P2| / (4 n^2),
+			# 'steps' is the upper limit
+			curve_steps = numpy.ceil(numpy.sqrt(numpy.hypot(*((p1 - 2 * cp + p2) * scale).T) / (4 * alterpcb_core.export_tolerance)))
+			curve_steps = numpy.clip(curve_steps, 1, steps).astype(int)
+			px = []
+			py = []
+			for i in range(n):
+				if oncurve[i]:
+					if oncurve[i - 1]:
+						px.append(cp[i : i + 1, 0])
+						py.append(cp[i : i + 1, 1])
+				else:
+					t = (numpy.arange(curve_steps[i]) + 1) / curve_steps[i]
+					px.append(bezier2(p1[i, 0], cp[i, 0], p2[i, 0], t))
+					py.append(bezier2(p1[i, 1], cp[i, 1], p2[i, 1], t))
+			px = numpy.concatenate(px)
+			py = numpy.concatenate(py)
+			contours.append((px, py, polygon_direction(px, py) == "ccw"))
+		glyph_cache[key] = (face.glyph.advance.x, contours)
+	return glyph_cache[key]
+
+def load_kerning(font, left, right):
+	key = (font, left, right)
+	if key not in kerning_cache:
+		kerning_cache[key] = loaded_fonts[font].get_kerning(left, right, freetype.FT_KERNING_UNSCALED).x
+	return kerning_cache[key]
+
+@component(transform=transform_text, transform_many=transform_many_text, lod_box=True)
 def text(x=0.0, y=0.0, angle=0.0, mirror=False, layer="silk-top", text="Text", font="DejaVuSans", size=2.0, halign="left", valign="baseline", spacing=0.0, steps=8, hole=False, order=0):
 	pcb = alterpcb_core.Pcb()
 	
@@ -46,15 +117,14 @@ def text(x=0.0, y=0.0, angle=0.0, mirror=False, layer="silk-top", text="Text", f
 	face = loaded_fonts[font]
 	xscale = size / face.units_per_EM
 	yscale = size / face.units_per_EM
+	glyphs = [load_glyph(font, ch, size, steps) for ch in text]
 	
 	# calculate total width
 	total_width = 0.0
 	for ch in range(len(text)):
-		face.load_char(text[ch], freetype.FT_LOAD_NO_HINTING | freetype.FT_LOAD_NO_SCALE)
 		if ch != 0:
-			kerning = face.get_kerning(text[ch - 1], text[ch], freetype.FT_KERNING_UNSCALED)
-			total_width += kerning.x * xscale + spacing
-		total_width += face.glyph.advance.x * xscale
+			total_width += load_kerning(font, text[ch - 1], text[ch]) * xscale + spacing
+		total_width += glyphs[ch][0] * xscale
 	
 	# calculate start position
 	if halign == "left":
@@ -78,55 +148,21 @@ def text(x=0.0, y=0.0, angle=0.0, mirror=False, layer="silk-top", text="Text", f
 	
 	# convert to polygons
 	for ch in range(len(text)):
-		
-		# load one glyph
-		face.load_char(text[ch], freetype.FT_LOAD_NO_HINTING | freetype.FT_LOAD_NO_SCALE)
-		outline = face.glyph.outline
+		(advance, contours) = glyphs[ch]
 		
 		# move position
 		if ch != 0:
-			kerning = face.get_kerning(text[ch - 1], text[ch], freetype.FT_KERNING_UNSCALED)
-			pos_x += kerning.x * xscale + spacing
+			pos_x += load_kerning(font, text[ch - 1], text[ch]) * xscale + spacing
 		
 		# add polygons
-		start = 0
-		for contour in outline.contours:
-			end = contour + 1
-			points = outline.points[start:end]
-			tags = outline.tags[start:end]
-			start = end
-			
-			oncurve = [bool((tags[i] >> 0) & 1) for i in range(len(points))]
-			thirdorder = [bool((tags[i] >> 1) & 1) for i in range(len(points))]
-			hasmode = [bool((tags[i] >> 2) & 1) for i in range(len(points))]
-			mode = [(tags[i] >> 5) & 0x7 for i in range(len(points))]
-			
-			t = (numpy.arange(steps) + 1) / steps
-			n = len(oncurve)
-			px = []
-			py = []
-			for i in range(len(points)):
-				if oncurve[i]:
-					if oncurve[i - 1]:
-						px.append(points[i][0])
-						py.append(points[i][1])
-				else:
-					assert(not thirdorder[i])
-					x1 = points[i - 1][0] if oncurve[i - 1] else (points[i][0] + points[i - 1][0]) / 2
-					y1 = points[i - 1][1] if oncurve[i - 1] else (points[i][1] + points[i - 1][1]) / 2
-					x2 = points[i + 1 - n][0] if oncurve[i + 1 - n] else (points[i][0] + points[i + 1 - n][0]) / 2
-					y2 = points[i + 1 - n][1] if oncurve[i + 1 - n] else (points[i][1] + points[i + 1 - n][1]) / 2
-					xx = bezier2(x1, points[i][0], x2, t)
-					yy = bezier2(y1, points[i][1], y2, t)
-					px.extend(xx)
-					py.extend(yy)
-			hh = (1 if hole else 0) + (1 if polygon_direction(px, py) == "ccw" else 0)
-			px = pos_x + numpy.array(px) * xscale
-			py = pos_y + numpy.array(py) * yscale
+		for (cx, cy, ccw) in contours:
+			hh = (1 if hole else 0) + (1 if ccw else 0)
+			px = pos_x + cx * xscale
+			py = pos_y + cy * yscale
 			(px, py) = alterpcb_core.transform_point(px, py, 0.0, 0.0, x, y, angle, False, mirror)
 			pcb.add("polygon", layer=layer, x=px, y=py, hole=bool(hh % 2), order=order + hh // 2)
 		
 		# move position again
-		pos_x += face.glyph.advance.x * xscale
+		pos_x += advance * xscale
 	
 	return pcb